@@ -1,13 +1,34 @@
 #!/usr/bin/python3
 
 from todoist.api import TodoistAPI
+from todoist import models
 import os
 import sys
 import time
 import requests
 import argparse
 import logging
-from datetime import datetime, timedelta
+import re
+import json
+import pickle
+import hashlib
+import hmac
+import base64
+import sqlite3
+import copy
+import gc
+import heapq
+import threading
+import multiprocessing
+import queue
+import atexit
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from collections import namedtuple
+from datetime import datetime, date
+from functools import lru_cache, partial
+from contextlib import contextmanager
 import time
 
 # Makes --help text wider
@@ -31,12 +52,34 @@ def make_wide(formatter, w=120, h=36):
 def sync(api):
     try:
         logging.debug('Syncing the current state from the API')
-        api.sync()
+        response = api.sync()
     except Exception as e:
         logging.exception(
             'Error trying to sync with Todoist API: %s' % str(e))
         quit()
 
+    return response
+
+# Replace the local state after failed commands
+
+
+def resync(api):
+    """Runs a full sync, as the changes of failed commands are still in the local models."""
+    logging.warning('Not all changes were committed, running a full sync')
+    api.reset_state()
+    return sync(api)
+
+# Check if a sync returned any changed objects
+
+
+def sync_has_changes(response):
+    if not isinstance(response, dict):
+        return False
+    for key in ['items', 'projects', 'sections', 'labels', 'notes']:
+        if response.get(key):
+            return True
+    return False
+
 # Simple query for yes/no answer
 
 
@@ -72,40 +115,46 @@ def query_yes_no(question, default="yes"):
             sys.stdout.write("Please respond with 'yes' or 'no' "
                              "(or 'y' or 'n').\n")
 
-# Check if label exists, if not, create it
+# Check if labels exist, if not, create them all at once
 
 
-def verify_label_existance(args, api, label_name, prompt_mode):
-    # Check the regeneration label exists
-    label = api.labels.all(lambda x: x['name'] == label_name)
+def verify_labels(api, label_names, prompt_names=[]):
+    """Returns the id per label name, creating missing labels in a single commit."""
+    label_ids = {}
+    for label in api.state['labels']:
+        label_ids.setdefault(label['name'], label['id'])
 
-    if len(label) > 0:
-        label_id = label[0]['id']
-        logging.debug('Label \'%s\' found as label id %d',
-                      args.label, label_id)
-    else:
-        # Create a new label in Todoist
-        logging.info(
-            "\n\nLabel '{}' doesn't exist in your Todoist\n".format(label_name))
-        # sys.exit(1)
-        if prompt_mode == 1:
+    missing = [x for x in dict.fromkeys(label_names) if x not in label_ids]
+
+    if missing:
+        for label_name in missing:
+            logging.info(
+                "\n\nLabel '{}' doesn't exist in your Todoist\n".format(label_name))
+
+        # Ask the user before creating some of the labels
+        if set(missing) & set(prompt_names):
             response = query_yes_no(
                 'Do you want to automatically create this label?')
         else:
             response = True
 
-        if response:
-            api.labels.add(label_name)
-            api.commit()
-            api.sync()
-            label = api.labels.all(lambda x: x['name'] == label_name)
-            label_id = label[0]['id']
-            logging.info("Label '{}' has been created!".format(label_name))
-        else:
+        if not response:
             logging.info('Exiting Autodoist.')
             exit(1)
 
-    return label_id
+        labels = [api.labels.add(x) for x in missing]
+        api.commit()
+
+        # The commit replaces the temporary ids, so no extra sync is needed
+        for label in labels:
+            label_ids[label['name']] = label['id']
+            logging.info("Label '{}' has been created!".format(label['name']))
+
+    for label_name in label_names:
+        logging.debug('Label \'%s\' found as label id %s',
+                      label_name, label_ids[label_name])
+
+    return label_ids
 
 
 # Initialisation of Autodoist
@@ -157,37 +206,49 @@ def initialise(args):
         logging.debug('Disabling local caching')
         api_arguments['cache'] = None
 
-    api = TodoistAPI(**api_arguments)
+    if args.binary_cache and not args.nocache:
+        logging.debug('Using the binary sync cache')
+        api = CachedTodoistAPI(args.api_key, get_cache_path(args))
+    else:
+        api = TodoistAPI(**api_arguments)
     sync(api)
 
-    # If labeling argument is used
-    if args.label is not None:
+    # Load the bookkeeping of previous runs, independent of the API cache
+    state = StateStore(get_state_path(args))
+    if len(state) == 0:
+        state.import_models(api)
+    state.prune(api)
+    state.flush()
 
-        # Verify that the next action label exists; ask user if it needs to be created
-        label_id = verify_label_existance(args, api, args.label, 1)
-        
-        # Get blocked label id
-        blocked_label_id = verify_label_existance(args, api, args.blocked_label, 2)
+    # Verify all required labels in a single pass
+    label_names = []
+    if args.label is not None:
+        label_names.append(args.label)
+        if args.blocked_label is not None:
+            label_names.append(args.blocked_label)
+    if args.regeneration is not None:
+        label_names += list(args.regen_label_names)
 
+    # Ask before creating the next action label, unless multiple accounts
+    # are served without a terminal to prompt on
+    if args.label is not None and not args.accounts:
+        prompt_names = [args.label]
     else:
-        # Label functionality not needed
-        label_id = None
-        blocked_label_id = None
+        prompt_names = []
 
-    logging.info("Autodoist has connected and is running fine!\n")
+    label_ids = verify_labels(api, label_names, prompt_names)
 
-    # If regeneration mode is used, verify labels
+    # Label functionality not needed if not set
+    label_id = label_ids.get(args.label)
+    blocked_label_id = label_ids.get(args.blocked_label)
     if args.regeneration is not None:
-
-        # Verify the existance of the regeneraton labels; force creation of label
-        regen_labels_id = [verify_label_existance(
-            args, api, regen_label, 2) for regen_label in args.regen_label_names]
-
+        regen_labels_id = [label_ids[x] for x in args.regen_label_names]
     else:
-        # Label functionality not needed
         regen_labels_id = [None, None, None]
 
-    return api, label_id, blocked_label_id, regen_labels_id
+    logging.info("Autodoist has connected and is running fine!\n")
+
+    return api, state, label_id, blocked_label_id, regen_labels_id
 
 # Check for Autodoist update
 
@@ -196,7 +257,7 @@ def check_for_update(current_version):
     updateurl = 'https://api.github.com/repos/Hoffelhas/autodoist/releases'
 
     try:
-        r = requests.get(updateurl)
+        r = requests.get(updateurl, timeout=10)
         r.raise_for_status()
         release_info_json = r.json()
 
@@ -218,56 +279,451 @@ def check_for_update(current_version):
         logging.error("Error while checking for updates: {}".format(e))
         return 1
 
+# Compile the configured suffixes once and cache the type per name
+
+
+class NameClassifier(object):
+    """Classifies names by their suffix, with one dict lookup per known name."""
+
+    max_cache_size = 100000
+
+    def __init__(self, args):
+        self.inbox = args.inbox
+
+        rules = [(args.pp_suffix, 'parallel'), (args.ss_suffix, 'sequential'),
+                 (args.ps_suffix, 'p-s'), (args.sp_suffix, 's-p')]
+
+        # Workaround for section names, which don't allow / symbol.
+        if args.ps_suffix == '/-':
+            rules.append(('_-', 'p-s'))
+        if args.sp_suffix == '-/':
+            rules.append(('-_', 's-p'))
+        if args.pp_suffix == '//':
+            rules.append(('_', 'parallel'))
+
+        self.rules = [(suffix, name_type) for suffix, name_type in rules if suffix]
+        self.cache = {}
+
+    def classify(self, name):
+        try:
+            return self.cache[name]
+        except KeyError:
+            pass
+
+        if name == 'Inbox':
+            current_type = self.inbox
+        else:
+            current_type = None
+            for suffix, name_type in self.rules:
+                if name.endswith(suffix):
+                    current_type = name_type
+                    break
+
+        # Names rarely change, but don't let renames grow the cache forever
+        if len(self.cache) >= self.max_cache_size:
+            self.cache.clear()
+        self.cache[name] = current_type
+
+        return current_type
+
 # Assign current type based on settings
 
 
 def check_name(args, name):
-    len_suffix = [len(args.pp_suffix), len(args.ss_suffix),
-                  len(args.ps_suffix), len(args.sp_suffix)]
-
-    if name == 'Inbox':
-        current_type = args.inbox
-    elif name[-len_suffix[0]:] == args.pp_suffix:
-        current_type = 'parallel'
-    elif name[-len_suffix[1]:] == args.ss_suffix:
-        current_type = 'sequential'
-    elif name[-len_suffix[1]:] == args.ps_suffix:
-        current_type = 'p-s'
-    elif name[-len_suffix[1]:] == args.sp_suffix:
-        current_type = 's-p'
-    # Workaround for section names, which don't allow / symbol.
-    elif args.ps_suffix == '/-' and name[-2:] == '_-':
-        current_type = 'p-s'
-    # Workaround for section names, which don't allow / symbol.
-    elif args.sp_suffix == '-/' and name[-2:] == '-_':
-        current_type = 's-p'
-    # Workaround for section names, which don't allow / symbol.
-    elif args.pp_suffix == '//' and name[-1:] == '_':
-        current_type = 'parallel'
-    else:
-        current_type = None
+    classifier = getattr(args, 'name_classifier', None)
+    if classifier is None:
+        classifier = args.name_classifier = NameClassifier(args)
+
+    return classifier.classify(name)
+
+# Take a single snapshot of the clock per cycle
+
+
+Clock = namedtuple('Clock', ['now', 'today', 'hour'])
+
+
+def take_clock():
+    now = datetime.today()
+    return Clock(now, now.toordinal(), now.hour)
+
+# Convert a due date into an ordinal day number, ignoring the time
+
+
+@lru_cache(maxsize=4096)
+def date_ordinal(date_string):
+    return date(int(date_string[0:4]), int(date_string[5:7]), int(date_string[8:10])).toordinal()
+
+# Parse the start= and start=due- directives of a description once
+
+
+# The date is an ordinal day number, the offset a number of days
+StartRule = namedtuple('StartRule', ['kind', 'date', 'offset'])
+
+invalid_start_rule = StartRule('invalid', None, None)
+
+
+class DescriptionParser(object):
+    """Turns descriptions into start rules, caching the result per description."""
+
+    max_cache_size = 100000
+    start_date_pattern = re.compile(r'start=(\S*)')
+    start_due_pattern = re.compile(r'start=due-(\d+)([dw])(?=\s|$)')
 
-    return current_type
+    def __init__(self, args):
+        self.dateformat = args.dateformat
+        self.cache = {}
+
+    def parse(self, description, content):
+        try:
+            return self.cache[description]
+        except KeyError:
+            pass
+
+        if not description or 'start=' not in description:
+            rule = None
+        elif 'start=due-' in description:
+            match = self.start_due_pattern.search(description)
+            if match is None:
+                rule = invalid_start_rule
+                logging.warning(
+                    'Wrong start-date format for item: %s. Please use "start=due-<NUM><d or w>"', content)
+            elif match.group(2) == 'd':
+                rule = StartRule('due', None, int(match.group(1)))
+            else:
+                rule = StartRule('due', None, 7 * int(match.group(1)))
+        else:
+            match = self.start_date_pattern.search(description)
+            try:
+                rule = StartRule('date', datetime.strptime(
+                    match.group(1), self.dateformat).toordinal(), None)
+            except ValueError:
+                rule = invalid_start_rule
+                logging.warning(
+                    'Wrong start-date format for item: "%s". Please use "start=%s"', content, self.dateformat)
+
+        # Malformed descriptions are only reported once, as the result is cached
+        if len(self.cache) >= self.max_cache_size:
+            self.cache.clear()
+        self.cache[description] = rule
+
+        return rule
+
+
+def parse_start_rule(args, description, content):
+    parser = getattr(args, 'description_parser', None)
+    if parser is None:
+        parser = args.description_parser = DescriptionParser(args)
+
+    return parser.parse(description, content)
+
+# Keep Autodoist's own bookkeeping in a compact local store
+
+
+class StateStore(object):
+    """Keeps the bookkeeping fields per object id, persisted in a SQLite file."""
+
+    fields = ['date_old', 'parent_type', 'item_type',
+              'project_type', 'section_type', 'header_job']
+
+    def __init__(self, path=None):
+        self.path = path
+        self.values = {field: {} for field in self.fields}
+        self.changed = set()
+        self.connection = None
+
+        # Number of changes, the fingerprints of item trees that changed
+        # nothing, and the days on which date based rules change their
+        # outcome, which are only kept in memory
+        self.writes = 0
+        self.trees = {}
+        self.triggers = TriggerQueue()
+
+        if path is not None:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS state (field TEXT, id, value, PRIMARY KEY (field, id))')
+
+            # Forget fields that older versions kept
+            with self.connection:
+                self.connection.execute('DELETE FROM state WHERE field NOT IN ({})'.format(
+                    ', '.join('?' * len(self.fields))), self.fields)
+            for field, object_id, value in self.connection.execute('SELECT field, id, value FROM state'):
+                try:
+                    self.values[field][object_id] = value
+                except KeyError:
+                    pass
+
+    def __len__(self):
+        return sum(len(x) for x in self.values.values())
+
+    def get(self, field, object_id):
+        """Returns the stored value, or raises a KeyError if there is none."""
+        return self.values[field][object_id]
+
+    def set(self, field, object_id, value):
+        values = self.values[field]
+        if object_id in values and values[object_id] == value:
+            return
+        values[object_id] = value
+        self.changed.add((field, object_id))
+        self.writes += 1
+
+    def delete(self, field, object_id):
+        if self.values[field].pop(object_id, None) is not None:
+            self.changed.add((field, object_id))
+            self.writes += 1
+
+    def import_models(self, api):
+        """Takes over bookkeeping fields that older versions kept in the models."""
+        for key in ['items', 'projects', 'sections']:
+            for obj in api.state[key]:
+                for field in self.fields:
+                    if field in obj.data:
+                        self.set(field, obj['id'], obj.data.pop(field))
+
+    def prune(self, api):
+        """Forgets objects that no longer exist."""
+        ids = set()
+        for key in ['items', 'projects', 'sections']:
+            ids.update(x['id'] for x in api.state[key])
+        for field, values in self.values.items():
+            for object_id in [x for x in values if x not in ids]:
+                del values[object_id]
+                self.changed.add((field, object_id))
+
+    def dump(self):
+        return [[field, object_id, value] for field, values in self.values.items()
+                for object_id, value in values.items()]
+
+    def load(self, rows):
+        for field, object_id, value in rows:
+            self.set(field, object_id, value)
+
+    def subset(self, object_ids):
+        """Returns the values of the given objects, to evaluate them in another process."""
+        return {field: {x: values[x] for x in object_ids if x in values}
+                for field, values in self.values.items()}
+
+    def take_changes(self):
+        """Returns the changes since the previous call, as (field, id, present, value)."""
+        changes = []
+        for field, object_id in self.changed:
+            try:
+                changes.append(
+                    (field, object_id, True, self.values[field][object_id]))
+            except KeyError:
+                changes.append((field, object_id, False, None))
+        self.changed = set()
+        return changes
+
+    def apply(self, changes):
+        for field, object_id, present, value in changes:
+            if present:
+                self.set(field, object_id, value)
+            else:
+                self.delete(field, object_id)
+
+    def flush(self):
+        """Writes all changes since the previous flush in a single transaction."""
+        if self.connection is None or not self.changed:
+            self.changed = set()
+            return
+
+        upserts = []
+        deletes = []
+        for field, object_id in self.changed:
+            try:
+                upserts.append((field, object_id, self.values[field][object_id]))
+            except KeyError:
+                deletes.append((field, object_id))
+
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO state (field, id, value) VALUES (?, ?, ?)', upserts)
+            self.connection.executemany(
+                'DELETE FROM state WHERE field = ? AND id = ?', deletes)
+
+        self.changed = set()
+
+
+def get_state_path(args):
+    if args.state_file:
+        return os.path.expanduser(args.state_file)
+    token_hash = hashlib.sha1(args.api_key.encode('utf-8')).hexdigest()[:16]
+    return os.path.expanduser('~/.autodoist/{}.sqlite3'.format(token_hash))
+
+# Keep the synced state in a binary base file with an appended log of changes
+
+
+class SyncCache(object):
+    """Binary alternative to the JSON cache of the API, for large accounts."""
+
+    version = 1
+
+    # Only the objects the rules read are kept
+    keys = ['projects', 'sections', 'items', 'labels']
+    model_types = [models.Project, models.Section, models.Item, models.Label]
+
+    def __init__(self, path):
+        self.path = path
+        self.log_path = path + '.log'
+        self.lock = threading.Lock()
+        self.base_size = 0
+        self.log_size = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def load(self, api):
+        """Restores the state of the API from the base file and the log."""
+        try:
+            with open(self.path, 'rb') as f, gc_paused():
+                base = pickle.load(f)
+                self.base_size = f.tell()
+            if base.get('version') != self.version:
+                raise ValueError('unknown cache version')
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, EOFError, pickle.UnpicklingError) as e:
+            logging.warning('Ignoring unreadable sync cache %s: %s', self.path, e)
+            return
+
+        # Creating the models directly avoids a lookup per object
+        with gc_paused():
+            for key, model in zip(self.keys, self.model_types):
+                api.state[key] = [model(x, api) for x in base['state'][key]]
+        api.sync_token = base['sync_token']
+
+        # Replay the changes up to the last complete entry
+        try:
+            with open(self.log_path, 'rb') as f, gc_paused():
+                objects = {key: {x.data['id']: x for x in api.state[key]}
+                           for key in self.keys}
+                while True:
+                    try:
+                        delta = pickle.load(f)
+                    except EOFError:
+                        break
+                    except (pickle.UnpicklingError, ValueError) as e:
+                        logging.warning(
+                            'Sync cache log truncated after an incomplete entry: %s', e)
+                        break
+                    self.replay(api, objects, delta)
+                    self.log_size = f.tell()
+
+                for key in self.keys:
+                    api.state[key] = list(objects[key].values())
+
+            if os.path.getsize(self.log_path) != self.log_size:
+                os.truncate(self.log_path, self.log_size)
+        except FileNotFoundError:
+            pass
+
+        logging.debug('Loaded %d items from the sync cache',
+                      len(api.state['items']))
+
+    def replay(self, api, objects, delta):
+        """Applies a logged delta like _update_state, finding the objects by id."""
+        if 'sync_token' in delta:
+            api.sync_token = delta['sync_token']
+
+        for key, model in zip(self.keys, self.model_types):
+            key_objects = objects[key]
+            for remote in delta.get(key, []):
+                local = key_objects.get(remote['id'])
+                is_deleted = remote.get('is_deleted', 0)
+                if is_deleted == 0 or is_deleted is False:
+                    if local is not None:
+                        local.data.update(remote)
+                    else:
+                        key_objects[remote['id']] = model(remote, api)
+                elif local is not None:
+                    del key_objects[remote['id']]
+
+    def append(self, api, syncdata):
+        """Logs the changes of a sync, or rewrites the base file if needed."""
+        delta = {key: syncdata[key] for key in self.keys if syncdata.get(key)}
+        if 'sync_token' in syncdata:
+            delta['sync_token'] = syncdata['sync_token']
+
+        with self.lock:
+            # A full sync replaces everything, and a long log slows down the start
+            if syncdata.get('full_sync') or self.log_size > self.base_size:
+                self.compact(api)
+                return
+
+            # Syncs without changes keep the older token, which is still valid
+            if not any(key in delta for key in self.keys):
+                return
+
+            data = pickle.dumps(delta, protocol=pickle.HIGHEST_PROTOCOL)
+            with open(self.log_path, 'ab') as f:
+                f.write(data)
+            self.log_size += len(data)
+
+    def compact(self, api):
+        base = {'version': self.version, 'sync_token': api.sync_token,
+                'state': {key: [x.data for x in api.state[key]] for key in self.keys}}
+        data = pickle.dumps(base, protocol=pickle.HIGHEST_PROTOCOL)
+
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, self.path)
+
+        with open(self.log_path, 'wb'):
+            pass
+        self.base_size = len(data)
+        self.log_size = 0
+
+        logging.debug('Compacted the sync cache to %d bytes', self.base_size)
+
+
+class CachedTodoistAPI(TodoistAPI):
+    """Todoist API that keeps its state in a SyncCache instead of the JSON cache."""
+
+    def __init__(self, token, path):
+        super().__init__(token=token, cache=None)
+
+        # Loading replays the log, which should not be logged again
+        sync_cache = SyncCache(path)
+        sync_cache.load(self)
+        self.sync_cache = sync_cache
+
+    def _update_state(self, syncdata):
+        super()._update_state(syncdata)
+        sync_cache = getattr(self, 'sync_cache', None)
+        if sync_cache is not None:
+            sync_cache.append(self, syncdata)
+
+
+def get_cache_path(args):
+    token_hash = hashlib.sha1(args.api_key.encode('utf-8')).hexdigest()[:16]
+    return os.path.expanduser('~/.autodoist/{}.cache'.format(token_hash))
 
 # Scan the end of a name to find what type it is
 
 
-def get_type(args, object, key):
+def get_type(args, state, object, key):
 
     object_name = ''
 
     try:
-        old_type = object[key]
-    except:
+        old_type = state.get(key, object.id)
+    except KeyError:
         # logging.debug('No defined project_type: %s' % str(e))
         old_type = None
 
     try:
-        object_name = object['name'].strip()
-    except:
+        object_name = object.name.strip()
+    except AttributeError:
         try:
-            object_name = object['content'].strip()
-        except:
+            object_name = object.content.strip()
+        except AttributeError:
             pass
 
     current_type = check_name(args, object_name)
@@ -277,28 +733,29 @@ def get_type(args, object, key):
         type_changed = 0
     else:
         type_changed = 1
-        object[key] = current_type
+        if object.id is not None:
+            state.set(key, object.id, current_type)
 
     return current_type, type_changed
 
 # Determine a project type
 
 
-def get_project_type(args, project_object):
+def get_project_type(args, state, project_object):
     """Identifies how a project should be handled."""
     project_type, project_type_changed = get_type(
-        args, project_object, 'project_type')
+        args, state, project_object, 'project_type')
 
     return project_type, project_type_changed
 
 # Determine a section type
 
 
-def get_section_type(args, section_object):
+def get_section_type(args, state, section_object):
     """Identifies how a section should be handled."""
     if section_object is not None:
         section_type, section_type_changed = get_type(
-            args, section_object, 'section_type')
+            args, state, section_object, 'section_type')
     else:
         section_type = None
         section_type_changed = 0
@@ -308,18 +765,20 @@ def get_section_type(args, section_object):
 # Determine an item type
 
 
-def get_item_type(args, item, project_type):
+def get_item_type(args, state, item, project_type):
     """Identifies how an item with sub items should be handled."""
 
-    if project_type is None and item['parent_id'] != 0:
+    if project_type is None and item.parent_id != 0:
         try:
-            item_type = item['parent_type']
+            item_type = state.get('parent_type', item.id)
             item_type_changed = 1
-            item['item_type'] = item_type
-        except:
-            item_type, item_type_changed = get_type(args, item, 'item_type')
+            state.set('item_type', item.id, item_type)
+        except KeyError:
+            item_type, item_type_changed = get_type(
+                args, state, item, 'item_type')
     else:
-        item_type, item_type_changed = get_type(args, item, 'item_type')
+        item_type, item_type_changed = get_type(
+            args, state, item, 'item_type')
 
     return item_type, item_type_changed
 
@@ -327,31 +786,33 @@ def get_item_type(args, item, project_type):
 
 
 def add_label(item, label, overview_item_ids, overview_item_labels):
-    if label not in item['labels']:
-        labels = item['labels']
-        logging.debug('Updating \'%s\' with label', item['content'])
+    if label not in item.labels:
+        labels = item.labels
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug('Updating \'%s\' with label', item.content)
         labels.append(label)
 
         try:
-            overview_item_ids[str(item['id'])] += 1
+            overview_item_ids[str(item.id)] += 1
         except:
-            overview_item_ids[str(item['id'])] = 1
-        overview_item_labels[str(item['id'])] = labels
+            overview_item_ids[str(item.id)] = 1
+        overview_item_labels[str(item.id)] = labels
 
 # Logic to remove a label from an item
 
 
 def remove_label(item, label, overview_item_ids, overview_item_labels):
-    if label in item['labels']:
-        labels = item['labels']
-        logging.debug('Removing \'%s\' of its label', item['content'])
+    if label in item.labels:
+        labels = item.labels
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug('Removing \'%s\' of its label', item.content)
         labels.remove(label)
 
         try:
-            overview_item_ids[str(item['id'])] -= 1
+            overview_item_ids[str(item.id)] -= 1
         except:
-            overview_item_ids[str(item['id'])] = -1
-        overview_item_labels[str(item['id'])] = labels
+            overview_item_ids[str(item.id)] = -1
+        overview_item_labels[str(item.id)] = labels
 
 # Ensure labels are only issued once per item
 
@@ -367,70 +828,308 @@ def update_labels(api, label_id, overview_item_ids, overview_item_labels):
 
 
 def create_none_section():
-    none_sec = {
-        'id': None,
-        'name': 'None',
-        'section_order': 0
-    }
-    return none_sec
+    return SectionRecord({'id': None, 'name': 'None'})
+
+# Compact records of the fields the rules use, copied once per cycle
+
+
+class ProjectRecord(object):
+    __slots__ = ('id', 'name')
+
+    def __init__(self, data):
+        self.id = data['id']
+        self.name = data['name']
 
-# Check if header logic needs to be applied
 
+class SectionRecord(object):
+    __slots__ = ('id', 'name')
 
-def check_header(level):
-    header_all_in_level = False
-    unheader_all_in_level = False
-    method = 0
+    def __init__(self, data):
+        self.id = data['id']
+        self.name = data['name']
 
+
+class ItemRecord(object):
+    __slots__ = ('id', 'content', 'project_id', 'section_id', 'parent_id',
+                 'child_order', 'checked', 'labels', 'description', 'due')
+
+    def __init__(self, data):
+        self.id = data['id']
+        self.content = data['content']
+        self.project_id = data['project_id']
+        self.section_id = data.get('section_id')
+        # Top level items have parent id 0, in order to sort them
+        self.parent_id = data.get('parent_id') or 0
+        self.child_order = data['child_order']
+        self.checked = data['checked']
+        self.labels = list(data['labels'])
+        self.description = data.get('description', '')
+        self.due = data.get('due')
+
+
+# Creating many records triggers collector passes over the whole state, while
+# the records hold no reference cycles
+
+
+@contextmanager
+def gc_paused():
+    gc_enabled = gc.isenabled()
+    gc.disable()
     try:
-        name = level['name']
-        method = 1
-    except:
+        yield
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+class Snapshot(object):
+    """Records of the projects, sections, and items to evaluate, grouped once per cycle."""
+
+    def __init__(self, api=None, project_ids=None):
+        self.projects = []
+        self.index = {}
+        self.models = {ProjectRecord: {}, SectionRecord: {}, ItemRecord: {}}
+        self.child_map = {}
+        self.unchecked_child_map = {}
+        self.recurring = set()
+
+        if api is not None:
+            with gc_paused():
+                self.build(api.state['projects'], api.state['sections'],
+                           api.state['items'], project_ids)
+
+    def build(self, projects, sections, items, project_ids=None):
+        """Creates the records from models, or from plain data in a worker process."""
+        index = self.index
+        project_models = self.models[ProjectRecord]
+        section_models = self.models[SectionRecord]
+        item_models = self.models[ItemRecord]
+
+        for project in projects:
+            data = getattr(project, 'data', project)
+            if project_ids is not None and data['id'] not in project_ids:
+                continue
+            record = ProjectRecord(data)
+            self.projects.append(record)
+            index[record.id] = {'sections': [], 'items': {}}
+            if data is not project:
+                project_models[record.id] = project
+
+        for section in sections:
+            data = getattr(section, 'data', section)
+            try:
+                project_sections = index[data['project_id']]['sections']
+            except KeyError:
+                continue
+            record = SectionRecord(data)
+            project_sections.append(record)
+            if data is not section:
+                section_models[record.id] = section
+
+        for item in items:
+            data = getattr(item, 'data', item)
+            try:
+                section_items = index[data['project_id']]['items']
+            except KeyError:
+                continue
+            record = ItemRecord(data)
+            if data is not item:
+                item_models[record.id] = item
+
+            try:
+                section_items[record.section_id].append(record)
+            except KeyError:
+                section_items[record.section_id] = [record]
+
+            if record.parent_id:
+                try:
+                    self.child_map[record.parent_id].append(record)
+                except KeyError:
+                    self.child_map[record.parent_id] = [record]
+            elif record.due is not None and record.due.get('is_recurring'):
+                self.recurring.add(record.id)
+
+        # Map every parent to its ordered children, and to the unchecked ones
+        for parent_id, children in self.child_map.items():
+            children.sort(key=lambda x: x.child_order)
+            self.unchecked_child_map[parent_id] = [
+                x for x in children if x.checked == 0]
+
+    def add_models(self, projects, sections, items):
+        """Adds the models of the evaluated objects, to apply updates made elsewhere."""
+        for record_type, kind_models in [(ProjectRecord, projects), (SectionRecord, sections), (ItemRecord, items)]:
+            self.models[record_type].update((x.data['id'], x) for x in kind_models)
+
+    def items(self):
+        for project_index in self.index.values():
+            for items in project_index['items'].values():
+                yield from items
+
+# Write the decisions of the rules back to the models and the API queue
+
+
+class WriteBack(object):
+    """Turns changes to records into API commands on the matching models."""
+
+    def __init__(self, snapshot):
+        self.models = snapshot.models
+
+        # Without models, as in a worker process, the updates are only kept
+        self.updates = []
+        self.writes = 0
+
+    def update(self, record, **kwargs):
+        self.writes += 1
+        for key, value in kwargs.items():
+            if key in record.__slots__:
+                setattr(record, key, value)
+
+        # The none section only exists as a record
+        model = self.models[type(record)].get(record.id)
+        if model is not None:
+            model.update(**kwargs)
+        elif record.id is not None:
+            self.updates.append((type(record), record.id, kwargs))
+
+    def take_updates(self):
+        updates = self.updates
+        self.updates = []
+        return updates
+
+    def apply(self, updates):
+        """Applies the updates kept by a writer in a worker process."""
+        for kind, object_id, kwargs in updates:
+            model = self.models[kind].get(object_id)
+            if model is not None:
+                model.update(**kwargs)
+
+    def write_labels(self, overview_item_labels):
+        """Keeps the labels of the models in line with the queued label updates."""
+        models = self.models[ItemRecord]
+        for item_id, labels in overview_item_labels.items():
+            model = models.get(int(item_id))
+            if model is None:
+                model = models.get(item_id)
+            if model is not None:
+                model.data['labels'] = list(labels)
+
+# (Un)header all items of a project, section, or item in bounded chunks
+
+
+class HeaderJob(object):
+    """Adds or removes the header prefix of the items in a level, a limited number per cycle.
+
+    The ** or !* prefix of the level is only removed once the synced state
+    shows all items done, so an interrupted or failed job resumes on the
+    next cycle or run.
+    """
+
+    def __init__(self, state, level, key, header, batch_size):
+        self.level = level
+        self.key = key
+        self.header = header
+        self.budget = batch_size
+        self.pending = False
+        self.finished = False
+        self.written = []
+
+        # Number of items confirmed done, and the items written in the
+        # previous cycle that are not confirmed yet
         try:
-            content = level['content']
-            method = 2
-        except:
-            pass
+            value = state.get('header_job', level.id)
+        except KeyError:
+            value = None
+            logging.info('Starting to %s the items of \'%s\'', 'header' if header else 'unheader',
+                         getattr(level, key)[3:])
+        if value is None:
+            self.done, unconfirmed = 0, []
+        elif isinstance(value, int):
+            self.done, unconfirmed = value, []
+        else:
+            self.done, unconfirmed = json.loads(value)
+        self.unconfirmed = set(unconfirmed)
+
+    def apply(self, writer, item):
+        if item.content.startswith('*') == self.header:
+            if item.id in self.unconfirmed:
+                self.unconfirmed.discard(item.id)
+                self.done += 1
+            return
+        if self.budget == 0:
+            self.pending = True
+            return
+
+        if self.header:
+            writer.update(item, content='* ' + item.content)
+        else:
+            writer.update(item, content=item.content[2:])
+        self.budget -= 1
+        self.written.append(item.id)
+
+    def finish(self, writer, state):
+        """Keeps the progress of the job, or removes the prefix once all items are done."""
+        level = self.level
+
+        # Items written this cycle are only done once the next sync confirms them
+        if self.pending or self.written:
+            if level.id is not None:
+                state.set('header_job', level.id,
+                          json.dumps([self.done, self.written]))
+            logging.info('%d item(s) of \'%s\' done, continuing next cycle',
+                         self.done, getattr(level, self.key)[3:])
+            return
+
+        name = getattr(level, self.key)[3:]
+        if self.header and isinstance(level, ItemRecord):
+            # Header the item itself as well
+            writer.update(level, content='* ' + name)
+        else:
+            writer.update(level, **{self.key: name})
+        state.delete('header_job', level.id)
+        self.finished = True
+        if self.done:
+            logging.info('Finished to %s %d item(s) of \'%s\'', 'header' if self.header else 'unheader',
+                         self.done, name)
+
+# Check if header logic needs to be applied
+
+
+def check_header(args, state, level):
+    if isinstance(level, ItemRecord):
+        key = 'content'
+    else:
+        key = 'name'
+    name = getattr(level, key)
 
-    if method == 1:
+    if name is not None:
         if name[:3] == '** ':
-            header_all_in_level = True
-            level.update(name=name[3:])
+            return HeaderJob(state, level, key, True, args.header_batch)
         if name[:3] == '!* ':
-            unheader_all_in_level = True
-            level.update(name=name[3:])
-    elif method == 2:
-        if content[:3] == '** ':
-            header_all_in_level = True
-            level.update(content=content[3:])
-        if content[:3] == '!* ':
-            unheader_all_in_level = True
-            level.update(content=content[3:])
-    else:
-        pass
+            return HeaderJob(state, level, key, False, args.header_batch)
 
-    return header_all_in_level, unheader_all_in_level
+    return None
 
 # Check regen mode based on label name
 
 
-def check_regen_mode(api, item, regen_labels_id):
+def check_regen_mode(item, regen_labels_id):
 
-    labels = item['labels']
+    labels = item.labels
 
     overlap = set(labels) & set(regen_labels_id)
     overlap = [val for val in overlap]
 
     if len(overlap) > 1:
         logging.warning(
-            'Multiple regeneration labels used! Please pick only one for item: "{}".'.format(item['content']))
+            'Multiple regeneration labels used! Please pick only one for item: "{}".'.format(item.content))
         return None
 
     try:
         regen_label_id = overlap[0]
     except:
-        logging.debug(
-            'No regeneration label for item: %s' % item['content'])
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug(
+                'No regeneration label for item: %s', item.content)
         regen_label_id = [0]
 
     if regen_label_id == regen_labels_id[0]:
@@ -446,473 +1145,1987 @@ def check_regen_mode(api, item, regen_labels_id):
         return None
 
 
+# Uncheck all checked sub-tasks of a recurring task at once
+
+
+def regenerate_sub_tasks(writer, item, child_map, unchecked_child_map):
+    checked_items = []
+    stack = list(reversed(child_map.get(item.id, [])))
+    while stack:
+        child_item = stack.pop()
+        if child_item.checked:
+            checked_items.append(child_item)
+        stack.extend(reversed(child_map.get(child_item.id, [])))
+
+    for child_item in checked_items:
+        writer.update(child_item, checked=0, in_history=0)
+
+    # Keep the unchecked views of the parents up to date
+    for parent_id in set(x.parent_id for x in checked_items):
+        unchecked_child_map[parent_id] = [
+            x for x in child_map[parent_id] if x.checked == 0]
+
+    return len(checked_items)
+
 # Recurring lists logic
 
 
-def run_recurring_lists_logic(args, api, item, child_items, child_items_all, regen_labels_id):
+def run_recurring_lists_logic(args, writer, state, item, child_map, unchecked_child_map, regen_labels_id, clock):
+
+    child_items = unchecked_child_map.get(item.id, [])
 
-    if item['parent_id'] == 0:
+    if item.parent_id == 0:
         try:
-            if item['due']['is_recurring']:
+            if item.due['is_recurring']:
                 try:
                     # Check if the T0 task date has changed
-                    if item['due']['date'] != item['date_old']:
+                    date_old = state.get('date_old', item.id)
+                    if item.due['date'] != date_old:
 
                         # Save the new date for reference us
-                        item.update(
-                            date_old=item['due']['date'])
+                        state.set('date_old', item.id, item.due['date'])
 
-                        # Mark children for action based on mode
+                        # Regenerate the sub-tasks based on mode
                         if args.regeneration is not None:
 
                             # Check if task has a regen label
                             regen_mode = check_regen_mode(
-                                api, item, regen_labels_id)
+                                item, regen_labels_id)
 
                             # If no label, use general mode instead
                             if regen_mode is None:
                                 regen_mode = args.regeneration
-                                logging.debug('Using general recurring mode \'%s\' for item: %s',
-                                    regen_mode, item['content'])
-                            else:
+                                if logging.root.isEnabledFor(logging.DEBUG):
+                                    logging.debug('Using general recurring mode \'%s\' for item: %s',
+                                        regen_mode, item.content)
+                            elif logging.root.isEnabledFor(logging.DEBUG):
                                 logging.debug('Using recurring label \'%s\' for item: %s',
-                                    regen_mode, item['content'])
+                                    regen_mode, item.content)
 
-                            # Apply tags based on mode
-                            give_regen_tag = 0
+                            regenerate = False
 
                             if regen_mode == 1: # Regen all
-                                give_regen_tag = 1
+                                regenerate = True
                             elif regen_mode == 2: # Regen if all sub-tasks completed
                                 if not child_items:
-                                    give_regen_tag = 1
+                                    regenerate = True
 
-                            if give_regen_tag == 1:
-                                for child_item in child_items_all:
-                                    child_item['r_tag'] = 1
+                            if regenerate:
+                                num_items = regenerate_sub_tasks(
+                                    writer, item, child_map, unchecked_child_map)
+                                if num_items and logging.root.isEnabledFor(logging.DEBUG):
+                                    logging.debug('Regenerated %d sub-task(s) of item: %s',
+                                                  num_items, item.content)
 
                         # If alternative end of day, fix due date if needed
                         if args.end is not None:
-                            # Determine current hour
-                            t = datetime.today()
-                            current_hour = t.hour
 
                             # Check if current time is before our end-of-day
-                            if (args.end - current_hour) > 0:
+                            if (args.end - clock.hour) > 0:
 
                                 # Determine the difference in days set by todoist
-                                nd = [
-                                    int(x) for x in item['due']['date'].split('-')]
-                                od = [
-                                    int(x) for x in item['date_old'].split('-')]
-
-                                new_date = datetime(
-                                    nd[0], nd[1], nd[2])
-                                old_date = datetime(
-                                    od[0], od[1], od[2])
-                                today = datetime(
-                                    t.year, t.month, t.day)
-                                days_difference = (
-                                    new_date-today).days
-                                days_overdue = (
-                                    today - old_date).days
+                                days_difference = date_ordinal(
+                                    item.due['date']) - clock.today
+                                days_overdue = clock.today - \
+                                    date_ordinal(date_old)
 
                                 # Only apply if overdue and if it's a daily recurring tasks
                                 if days_overdue >= 1 and days_difference == 1:
 
-                                    # Find curreny date in string format
-                                    today_str = [str(x) for x in [
-                                        today.year, today.month, today.day]]
-                                    if len(today_str[1]) == 1:
-                                        today_str[1] = ''.join(
-                                            ['0', today_str[1]])
-
-                                    # Update due-date to today
-                                    item_due = item['due']
-                                    item_due['date'] = '-'.join(
-                                        today_str)
-                                    item.update(due=item_due)
-                                    # item.update(due={'date': '2020-05-29', 'is_recurring': True, 'string': 'every day'})
+                                    # Update due-date to today, keeping the time if one is set
+                                    item_due = dict(item.due)
+                                    item_due['date'] = date.fromordinal(
+                                        clock.today).isoformat() + item_due['date'][10:]
+                                    writer.update(item, due=item_due)
+                                    state.set(
+                                        'date_old', item.id, item_due['date'])
 
                 except:
                     # If date has never been saved before, create a new entry
-                    logging.debug(
-                        'New recurring task detected: %s' % item['content'])
-                    item['date_old'] = item['due']['date']
-                    api.items.update(item['id'])
+                    if logging.root.isEnabledFor(logging.DEBUG):
+                        logging.debug(
+                            'New recurring task detected: %s', item.content)
+                    state.set('date_old', item.id, item.due['date'])
 
         except:
             # logging.debug(
-            #     'Parent not recurring: %s' % item['content'])
+            #     'Parent not recurring: %s' % item.content)
             pass
 
-    if args.regeneration is not None and item['parent_id'] != 0:
+# Get the object id of a queued command, label updates use string ids
+
+
+def command_id(command):
+    object_id = command['args'].get('id')
+    try:
+        return int(object_id)
+    except (TypeError, ValueError):
+        return object_id
+
+# Track which projects were touched since the previous cycle
+
+
+class ChangeTracker(object):
+    """Determines which projects need to be evaluated based on the sync delta."""
+
+    def __init__(self, full_sweep):
+        self.full_sweep = full_sweep
+        self.last_sweep = None
+        self.item_projects = {}
+        self.section_projects = {}
+        self.pending = set()
+
+    def sweep_due(self, response):
+        if self.last_sweep is None:
+            return True
+        if response.get('full_sync'):
+            return True
+        if self.full_sweep > 0 and time.time() - self.last_sweep >= self.full_sweep:
+            return True
+        return False
+
+    def changed_projects(self, api, response, pipeline=None):
+        """Returns the project ids to evaluate, or None for a full sweep."""
+        if not isinstance(response, dict):
+            response = {}
+
+        if self.sweep_due(response):
+            self.last_sweep = time.time()
+            self.pending = set()
+            self.item_projects = {
+                x['id']: x['project_id'] for x in api.state['items']}
+            self.section_projects = {
+                x['id']: x['project_id'] for x in api.state['sections']}
+            logging.debug('Running a full sweep over all projects')
+            return None
+
+        self.track_response(response, pipeline)
+        project_ids = self.pending
+        self.pending = set()
+
+        logging.debug('Evaluating %d changed project(s)', len(project_ids))
+
+        return project_ids
+
+    def track_response(self, response, pipeline=None):
+        """Evaluates the projects touched by a sync or commit response next cycle."""
+        if response.get('full_sync'):
+            self.last_sweep = None
+            return
+
+        project_ids = self.pending
+
+        for project in response.get('projects', []):
+            project_ids.add(project['id'])
+
+        for section in response.get('sections', []):
+            # Also include the old project in case the section was moved
+            try:
+                project_ids.add(self.section_projects[section['id']])
+            except KeyError:
+                pass
+            project_ids.add(section['project_id'])
+            self.section_projects[section['id']] = section['project_id']
+
+        for item in response.get('items', []):
+            # Skip our own writes coming back from a pipelined commit
+            if pipeline is not None and pipeline.is_echo(item):
+                continue
+
+            # Also include the old project in case the item was moved
+            try:
+                project_ids.add(self.item_projects[item['id']])
+            except KeyError:
+                pass
+            project_ids.add(item['project_id'])
+            self.item_projects[item['id']] = item['project_id']
+
+    def mark(self, project_ids):
+        """Evaluates the given projects next cycle, or all projects if None."""
+        if project_ids is None:
+            self.last_sweep = None
+        else:
+            self.pending.update(project_ids)
+
+    def track_queue(self, api):
+        """Re-evaluates projects next cycle if we queued changes for them."""
+        for command in api.queue:
+            object_id = command_id(command)
+            if command['type'].startswith('item_'):
+                project_id = self.item_projects.get(object_id)
+            elif command['type'].startswith('section_'):
+                project_id = self.section_projects.get(object_id)
+            elif command['type'].startswith('project_'):
+                project_id = object_id
+            else:
+                project_id = None
+
+            if project_id is not None:
+                self.pending.add(project_id)
+
+# Keep the days on which date based rules change their outcome
+
+
+class TriggerQueue(object):
+    """Keeps the next day on which date based rules change the outcome of each project."""
+
+    def __init__(self):
+        self.days = {}
+        self.heap = []
+
+    def set(self, project_id, day):
+        """Replaces the day of a project, or removes it if None."""
+        if day is None:
+            self.days.pop(project_id, None)
+        elif self.days.get(project_id) != day:
+            # The previous entry is dropped once it reaches the top
+            self.days[project_id] = day
+            heapq.heappush(self.heap, (day, project_id))
+
+    def next_day(self):
+        heap = self.heap
+        while heap and self.days.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+        if heap:
+            return heap[0][0]
+        return None
+
+    def next_time(self):
+        """Returns the time of the next change, which is at midnight, or None."""
+        day = self.next_day()
+        if day is None:
+            return None
+        return datetime.fromordinal(day).timestamp()
+
+    def take(self, today):
+        """Returns the ids of the projects that changed by today."""
+        project_ids = set()
+        while True:
+            day = self.next_day()
+            if day is None or day > today:
+                break
+            _, project_id = heapq.heappop(self.heap)
+            del self.days[project_id]
+            project_ids.add(project_id)
+        return project_ids
+
+
+def wake_delay(state, start_time, delay):
+    """Shortens the delay after a cycle to wake up when date based rules change."""
+    wake_time = state.triggers.next_time()
+    if wake_time is not None and wake_time - start_time < delay:
+        return wake_time - start_time
+    return delay
+
+# Choose the delay between syncs based on recent activity
+
+
+class AdaptiveScheduler(object):
+    """Backs off while syncs are empty and tightens when changes are seen."""
+
+    def __init__(self, min_delay, max_delay, factor=2):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.delay = min_delay
+
+    def next_delay(self, changed):
+        if changed:
+            self.delay = self.min_delay
+            logging.debug(
+                'Changes found, polling again at the minimum delay of %d seconds', self.delay)
+        elif self.delay >= self.max_delay:
+            self.delay = self.max_delay
+            logging.debug(
+                'No changes found, polling at the maximum delay of %d seconds', self.delay)
+        else:
+            self.delay = min(self.delay * self.factor, self.max_delay)
+            logging.debug(
+                'No changes found, backing off to %d seconds', self.delay)
+
+        return self.delay
+
+# Commit the queue in bounded batches, retrying only the failed commands
+
+
+def is_retryable(error):
+    try:
+        http_code = int(error.get('http_code', 0))
+    except (AttributeError, TypeError, ValueError):
+        return True
+    return http_code == 429 or http_code >= 500
+
+
+def get_retry_after(error, attempt):
+    try:
+        return float(error['error_extra']['retry_after'])
+    except (KeyError, TypeError, ValueError):
+        return min(2 ** attempt, 60)
+
+
+def commit_queue(api, batch_size=100, retries=5, tracker=None):
+    """Commits all queued commands and returns how many of them succeeded."""
+    queue = list(api.queue)
+    del api.queue[:]
+
+    def send(commands):
+        response = api.sync(commands=commands)
+        # A commit also returns the changes since the previous sync, which the
+        # next sync will no longer return
+        if tracker is not None and isinstance(response, dict):
+            tracker.track_response(response)
+        return response
+
+    return commit_commands(queue, send, batch_size, retries)
+
+
+def commit_commands(queue, send, batch_size=100, retries=5):
+    batches = [queue[i:i + batch_size]
+               for i in range(0, len(queue), batch_size)]
+    committed = 0
+
+    for n, batch in enumerate(batches):
+        attempt = 0
+        while batch:
+            try:
+                response = send(batch)
+            except requests.exceptions.RequestException as e:
+                response = {'error': str(e), 'http_code': 503}
+
+            if not isinstance(response, dict):
+                response = {'error': str(response), 'http_code': 503}
+
+            # The whole request was rejected, e.g. when rate limited
+            if 'sync_status' not in response:
+                if not is_retryable(response) or attempt >= retries:
+                    logging.error('Failed to commit %d command(s): %s',
+                                  len(batch), response.get('error'))
+                    break
+                wait = get_retry_after(response, attempt)
+                logging.warning(
+                    'Commit rejected (%s), retrying in %d seconds', response.get('error'), wait)
+                time.sleep(wait)
+                attempt += 1
+                continue
+
+            # Keep only the commands that failed, but can succeed on a retry
+            failed = []
+            wait = 0
+            for command in batch:
+                status = response['sync_status'].get(command['uuid'])
+                if status == 'ok':
+                    committed += 1
+                elif is_retryable(status) and attempt < retries:
+                    failed.append(command)
+                    wait = max(wait, get_retry_after(status, attempt))
+                else:
+                    logging.error('Command %s for id %s failed: %s', command['type'],
+                                  command['args'].get('id'), status)
+
+            batch = failed
+            if batch:
+                logging.warning(
+                    'Retrying %d failed command(s) in %d seconds', len(batch), wait)
+                time.sleep(wait)
+                attempt += 1
+
+        if len(batches) > 1:
+            logging.info('Committed batch %d of %d (%d of %d commands done)',
+                         n + 1, len(batches), committed, len(queue))
+
+    return committed
+
+# Send commands without reading back any state, so it can run next to a sync
+
+
+def post_commands(api, commands, timeout=60):
+    # A hung request would otherwise block the next cycle forever
+    response = api.session.post(api.get_api_url() + 'sync',
+                                data={'token': api.token,
+                                      'commands': json.dumps(commands),
+                                      'resource_types': '[]'},
+                                timeout=timeout)
+    try:
+        return response.json()
+    except ValueError:
+        return {'error': response.text, 'http_code': response.status_code}
+
+# Commit the queue of one cycle while the next cycle syncs
+
+
+class CommitPipeline(object):
+    """Runs commits on a background thread, one at a time and in order."""
+
+    # Fields that the rules read, used to recognise our own writes
+    echo_fields = ['content', 'checked', 'labels', 'description', 'due',
+                   'parent_id', 'section_id', 'project_id', 'child_order']
+
+    def __init__(self, batch_size, retries):
+        self.batch_size = batch_size
+        self.retries = retries
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.future = None
+        self.failed = False
+        self.echoes = {}
+        self.previous_echoes = {}
+
+    def get_echo(self, data):
+        echo = {}
+        for key in self.echo_fields:
+            value = data.get(key)
+            if key == 'due' and value is not None:
+                value = (value.get('date'), value.get('is_recurring'))
+            elif key == 'parent_id' and not value:
+                value = 0
+            elif key == 'labels' and value is not None:
+                value = sorted(value)
+            echo[key] = value
+        return echo
+
+    def submit(self, api):
+        commands = list(api.queue)
+        del api.queue[:]
+
+        # Remember what our writes look like, so they are not seen as foreign changes
+        written = set(command_id(x)
+                      for x in commands if x['type'] == 'item_update')
+        self.previous_echoes = self.echoes
+        self.echoes = {x['id']: self.get_echo(x.data)
+                       for x in api.state['items'] if x['id'] in written}
+
+        # Only one commit runs at a time, so the order of cycles is kept
+        self.wait()
+        self.future = self.executor.submit(self.commit, api, commands)
+
+    def commit(self, api, commands):
+        t0 = time.perf_counter()
+        committed = commit_commands(commands, lambda x: post_commands(
+            api, x), self.batch_size, self.retries)
+        metrics.observe('autodoist_commit_seconds', time.perf_counter() - t0)
+        metrics.inc('autodoist_commands_committed_total', committed)
+        if committed < len(commands):
+            self.failed = True
+        return committed
+
+    def wait(self):
+        if self.future is None:
+            return 0
+        try:
+            return self.future.result()
+        except Exception as e:
+            logging.error('Commit failed: %s', e)
+            self.failed = True
+            return 0
+        finally:
+            self.future = None
+
+    def is_echo(self, remote):
+        for echoes in [self.echoes, self.previous_echoes]:
+            echo = echoes.get(remote['id'])
+            if echo is not None and echo == self.get_echo(remote):
+                del echoes[remote['id']]
+                return True
+        return False
+
+# Collect timings and counts of every cycle
+
+
+class Metrics(object):
+    """Keeps counters and histograms, rendered in the Prometheus text format."""
+
+    buckets = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    size_buckets = (0, 1, 5, 10, 50, 100, 500, 1000, 5000)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.descriptions = {}
+        self.labels = {}
+
+        self.add_histogram('autodoist_sync_seconds',
+                           'Time spent syncing with Todoist.')
+        self.add_histogram('autodoist_evaluate_seconds',
+                           'Time spent in autodoist_magic.')
+        self.add_histogram('autodoist_update_labels_seconds',
+                           'Time spent queueing label updates.')
+        self.add_histogram('autodoist_commit_seconds',
+                           'Time spent committing the queue to Todoist.')
+        self.add_histogram('autodoist_queue_length',
+                           'Number of queued commands per cycle.', self.size_buckets)
+        self.add_counter('autodoist_cycles_total',
+                         'Number of completed cycles.')
+        self.add_counter('autodoist_cycle_overruns_total',
+                         'Number of cycles that took longer than the delay.')
+        self.add_counter('autodoist_labels_added_total',
+                         'Number of next action labels added.')
+        self.add_counter('autodoist_labels_removed_total',
+                         'Number of next action labels removed.')
+        self.add_counter('autodoist_commands_committed_total',
+                         'Number of commands committed to Todoist.')
+        self.add_counter('autodoist_webhook_events_total',
+                         'Number of accepted webhook events.')
+        self.add_counter('autodoist_stage_items_total',
+                         'Number of items handled per rule stage.', 'stage')
+        self.add_counter('autodoist_stage_seconds_total',
+                         'Time spent per rule stage.', 'stage')
+        self.add_counter('autodoist_items_skipped_total',
+                         'Number of items in unchanged trees that were not evaluated again.')
+
+    def add_counter(self, name, description, label=None):
+        self.counters[name] = {} if label else 0
+        self.descriptions[name] = description
+        self.labels[name] = label
+
+    def add_histogram(self, name, description, buckets=None):
+        buckets = buckets or self.buckets
+        self.histograms[name] = [buckets, [0] * len(buckets), 0, 0]
+        self.descriptions[name] = description
+
+    def inc(self, name, value=1, label_value=None):
+        with self.lock:
+            if label_value is None:
+                self.counters[name] += value
+            else:
+                counter = self.counters[name]
+                counter[label_value] = counter.get(label_value, 0) + value
+
+    def observe(self, name, value):
+        with self.lock:
+            histogram = self.histograms[name]
+            for i, bound in enumerate(histogram[0]):
+                if value <= bound:
+                    histogram[1][i] += 1
+            histogram[2] += value
+            histogram[3] += 1
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, value in self.counters.items():
+                lines.append('# HELP {} {}'.format(name, self.descriptions[name]))
+                lines.append('# TYPE {} counter'.format(name))
+                if self.labels[name]:
+                    for label_value, x in value.items():
+                        lines.append('{}{{{}="{}"}} {}'.format(
+                            name, self.labels[name], label_value, x))
+                else:
+                    lines.append('{} {}'.format(name, value))
+
+            for name, (buckets, counts, total, count) in self.histograms.items():
+                lines.append('# HELP {} {}'.format(name, self.descriptions[name]))
+                lines.append('# TYPE {} histogram'.format(name))
+                for bound, bucket_count in zip(buckets, counts):
+                    lines.append('{}_bucket{{le="{}"}} {}'.format(
+                        name, bound, bucket_count))
+                lines.append('{}_bucket{{le="+Inf"}} {}'.format(name, count))
+                lines.append('{}_sum {}'.format(name, total))
+                lines.append('{}_count {}'.format(name, count))
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+# Expose the metrics over a local HTTP endpoint
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Keep scrapes out of the log
+        pass
+
+
+def start_metrics_server(host, port):
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as e:
+        logging.error('Could not start the metrics endpoint: %s', e)
+        sys.exit(1)
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    logging.info('Serving metrics at http://%s:%d/metrics', host, port)
+
+    return server
+
+# Collect the projects touched by incoming Todoist webhook events
+
+
+class WebhookReceiver(object):
+    """Marks projects dirty from webhook events and wakes the main loop."""
+
+    def __init__(self, secret=None):
+        self.secret = secret
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.project_ids = set()
+        self.everything = False
+
+    def verify(self, body, signature):
+        if not self.secret:
+            return True
+        if signature is None:
+            return False
+        digest = hmac.new(self.secret.encode('utf-8'),
+                          body, hashlib.sha256).digest()
+        return hmac.compare_digest(base64.b64encode(digest).decode('ascii'), signature.strip())
+
+    def handle(self, payload):
+        event_name = payload.get('event_name', '')
+        event_data = payload.get('event_data') or {}
+
+        if event_name.startswith('project:'):
+            project_id = event_data.get('id')
+        elif event_name.startswith('item:') or event_name.startswith('section:'):
+            project_id = event_data.get('project_id')
+        elif event_name.startswith('note:'):
+            project_id = (event_data.get('item') or {}).get('project_id')
+        else:
+            # Label and other events can affect any project
+            project_id = None
+
+        # Webhooks send the ids as strings, the synced state keeps integers
+        if project_id is not None:
+            try:
+                project_id = int(project_id)
+            except (TypeError, ValueError):
+                project_id = None
+
+        with self.lock:
+            if project_id is None:
+                self.everything = True
+            else:
+                self.project_ids.add(project_id)
+
+        logging.debug('Webhook event %s for project %s',
+                      event_name, project_id)
+        metrics.inc('autodoist_webhook_events_total')
+        self.event.set()
+
+    def wait(self, timeout):
+        """Returns True if woken by an event, False if the timeout passed."""
+        return self.event.wait(max(timeout, 0))
+
+    def take(self):
+        """Returns the projects marked since the last call, or None for all projects."""
+        with self.lock:
+            self.event.clear()
+            project_ids = None if self.everything else self.project_ids
+            self.project_ids = set()
+            self.everything = False
+        return project_ids
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+
+    receiver = None
+
+    # Events are small, larger bodies are refused before reading them
+    max_body_size = 1024 * 1024
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            self.send_error(400)
+            return
+        if length < 0 or length > self.max_body_size:
+            self.send_error(413)
+            return
+        body = self.rfile.read(length)
+
+        if not self.receiver.verify(body, self.headers.get('X-Todoist-Hmac-SHA256')):
+            logging.warning('Rejected a webhook event with an invalid signature')
+            self.send_error(401)
+            return
+
+        try:
+            payload = json.loads(body.decode('utf-8'))
+        except ValueError:
+            self.send_error(400)
+            return
+        if not isinstance(payload, dict):
+            self.send_error(400)
+            return
+
+        self.receiver.handle(payload)
+
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        # Keep deliveries out of the log
+        pass
+
+
+def start_webhook_server(host, port, secret):
+    receiver = WebhookReceiver(secret)
+    handler = type('BoundWebhookHandler', (WebhookHandler,),
+                   {'receiver': receiver})
+
+    try:
+        server = ThreadingHTTPServer((host, port), handler)
+    except OSError as e:
+        logging.error('Could not start the webhook receiver: %s', e)
+        sys.exit(1)
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    logging.info('Receiving webhook events at http://%s:%d/', host, port)
+    if not secret:
+        logging.warning(
+            'No webhook secret is set, so event signatures are not verified')
+
+    return receiver
+
+# Contains all main autodoist functionalities
+
+
+def autodoist_magic(args, api, label_id, blocked_label_id, regen_labels_id, project_ids=None, clock=None, state=None, evaluator=None):
+    # The evaluation creates little garbage, but many short-lived objects
+    with gc_paused():
+        return evaluate_projects(args, api, label_id, blocked_label_id, regen_labels_id, project_ids, clock, state, evaluator)
+
+# Everything the rule stages share during one evaluation
+
+
+class RuleContext(object):
+    """Holds the options, bookkeeping, and current project and section of an evaluation."""
+
+    def __init__(self, args, state, writer, snapshot, clock, label_id, blocked_label_id, regen_labels_id):
+        self.args = args
+        self.state = state
+        self.writer = writer
+        self.clock = clock
+        self.label_id = label_id
+        self.blocked_label_id = blocked_label_id
+        self.regen_labels_id = regen_labels_id
+        self.child_map = snapshot.child_map
+        self.unchecked_child_map = snapshot.unchecked_child_map
+        self.recurring = snapshot.recurring
+        self.tree_values = [state.values[x] for x in tree_fields]
+        self.overview_item_ids = {}
+        self.overview_item_labels = {}
+        self.debug = logging.root.isEnabledFor(logging.DEBUG)
+
+        # Label helpers bound to this evaluation
+        self.add_label = partial(add_label, label=label_id, overview_item_ids=self.overview_item_ids,
+                                 overview_item_labels=self.overview_item_labels)
+        self.remove_label = partial(remove_label, label=label_id, overview_item_ids=self.overview_item_ids,
+                                    overview_item_labels=self.overview_item_labels)
+
+        # Set per project, per section, and per item while evaluating
+        self.project_type = None
+        self.project_job = None
+        self.header_items = set()
+        self.first_found_project = False
+        self.section_type = None
+        self.section_job = None
+        self.first_found_section = False
+        self.child_items = []
+        self.item_type = None
+        self.item_type_changed = 0
+        self.active_type = None
+        self.tree_wake_day = None
+        self.project_wake_day = None
+
+    def wake_at(self, day):
+        """Evaluates the current tree and project again on the given day."""
+        if self.tree_wake_day is None or day < self.tree_wake_day:
+            self.tree_wake_day = day
+        if self.project_wake_day is None or day < self.project_wake_day:
+            self.project_wake_day = day
+
+# A single rule, which is only created if its option is enabled
+
+
+class Stage(object):
+    """Applies one rule to an item, and returns False to skip the remaining stages."""
+
+    name = None
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.stops = 0
+        self.sampled = 0
+        self.seconds = 0.0
+
+    @staticmethod
+    def enabled(ctx):
+        return True
+
+    def run(self, item):
+        return True
+
+
+class HeaderStage(Stage):
+    """Adds or removes the header prefix of items and their children."""
+
+    name = 'header'
+
+    def run(self, item):
+        ctx = self.ctx
+        writer = ctx.writer
+
+        # Check if we need to (un)header entire item tree
+        job = check_header(ctx.args, ctx.state, item)
+        if job is not None:
+            for ci in ctx.child_items:
+                job.apply(writer, ci)
+            job.finish(writer, ctx.state)
+
+            # Keep the prefix of the item until its own job is done, and
+            # leave its children to it until then
+            if not job.finished:
+                ctx.header_items.update(x.id for x in ctx.child_items)
+                return True
+
+        # (Un)header the items of a project or section
+        if item.id not in ctx.header_items:
+            if ctx.project_job is not None:
+                ctx.project_job.apply(writer, item)
+            if ctx.section_job is not None:
+                ctx.section_job.apply(writer, item)
+
+        return True
+
+
+class RecurringStage(Stage):
+    """Regenerates sub-tasks and applies the alternative end-of-day."""
+
+    name = 'recurring'
+
+    @staticmethod
+    def enabled(ctx):
+        return ctx.args.regeneration is not None or bool(ctx.args.end)
+
+    def run(self, item):
+        ctx = self.ctx
+        if item.id in ctx.recurring:
+            run_recurring_lists_logic(ctx.args, ctx.writer, ctx.state, item, ctx.child_map,
+                                      ctx.unchecked_child_map, ctx.regen_labels_id, ctx.clock)
+        return True
+
+
+class ActionableStage(Stage):
+    """Stops at items that are checked or headers, which never get a label."""
+
+    name = 'actionable'
+
+    @staticmethod
+    def enabled(ctx):
+        return ctx.label_id is not None
+
+    def run(self, item):
+        if item.checked == 1:
+            return False
+        if item.content.startswith('*'):
+            # Remove next action label if it's still present
+            self.ctx.remove_label(item)
+            return False
+        return True
+
+
+class TypeStage(Stage):
+    """Detects the type of an item from its name or its parent."""
+
+    name = 'type'
+
+    @staticmethod
+    def enabled(ctx):
+        return ctx.label_id is not None
+
+    def run(self, item):
+        ctx = self.ctx
+        ctx.item_type, ctx.item_type_changed = get_item_type(
+            ctx.args, ctx.state, item, ctx.project_type)
+        if ctx.debug and ctx.item_type is not None:
+            logging.debug('Identified \'%s\' as %s type',
+                          item.content, ctx.item_type)
+        return True
+
+
+class NextActionStage(Stage):
+    """Labels the next actions according to the item, section, and project types."""
+
+    name = 'next_action'
+
+    @staticmethod
+    def enabled(ctx):
+        return ctx.label_id is not None
+
+    def run(self, item):
+        ctx = self.ctx
+        state = ctx.state
+        label_id = ctx.label_id
+        child_items = ctx.child_items
+        item_type = ctx.item_type
+        section_type = ctx.section_type
+        project_type = ctx.project_type
+
+        # Determine hierarchy types for logic
+        hierarchy_types = [item_type, section_type, project_type]
+        active_types = [type(x) != type(None) for x in hierarchy_types]
+
+        # If it is a parentless task
+        if item.parent_id == 0:
+            if active_types[0]:
+                # Do item types
+                ctx.active_type = item_type
+                ctx.add_label(item)
+
+            elif active_types[1]:
+                # Do section types
+                ctx.active_type = section_type
+
+                if section_type == 'sequential' or section_type == 's-p':
+                    if not ctx.first_found_section:
+                        ctx.add_label(item)
+                        ctx.first_found_section = True
+                    else:
+                        ctx.remove_label(item)
+                elif section_type == 'parallel' or section_type == 'p-s':
+                    ctx.add_label(item)
+
+            elif active_types[2]:
+                # Do project types
+                ctx.active_type = project_type
+
+                if project_type == 'sequential' or project_type == 's-p':
+                    if not ctx.first_found_project:
+                        ctx.add_label(item)
+                        ctx.first_found_project = True
+                    else:
+                        ctx.remove_label(item)
+
+                elif project_type == 'parallel' or project_type == 'p-s':
+                    ctx.add_label(item)
+
+            # Mark other conditions too
+            if ctx.first_found_section == False and active_types[1]:
+                ctx.first_found_section = True
+            if ctx.first_found_project is False and active_types[2]:
+                ctx.first_found_project = True
+
+        # If there are children
+        if len(child_items) > 0:
+            # Check if item state has changed, if so clean children for good measure
+            if ctx.item_type_changed == 1:
+                [ctx.remove_label(child_item) for child_item in child_items]
+
+            # If a sub-task, inherit parent task type
+            if item.parent_id != 0:
+                try:
+                    ctx.active_type = state.get('parent_type', item.id)
+                except KeyError:
+                    pass
+
+            active_type = ctx.active_type
+
+            # Process sequential tagged items (item_type can overrule project_type)
+            if active_type == 'sequential' or active_type == 'p-s':
+                for child_item in child_items:
+
+                    # Ignore headered children
+                    if child_item.content.startswith('*'):
+                        continue
+
+                    # Pass item_type down to the children
+                    state.set('parent_type', child_item.id, active_type)
+                    # Pass label down to the first child
+                    if child_item.checked == 0 and label_id in item.labels:
+                        ctx.add_label(child_item)
+                        ctx.remove_label(item)
+                    else:
+                        # Clean for good measure
+                        ctx.remove_label(child_item)
+
+            # Process parallel tagged items or untagged parents
+            elif active_type == 'parallel' or (active_type == 's-p' and label_id in item.labels):
+                ctx.remove_label(item)
+                for child_item in child_items:
+
+                    # Ignore headered children
+                    if child_item.content.startswith('*'):
+                        continue
+
+                    state.set('parent_type', child_item.id, active_type)
+                    if child_item.checked == 0:
+                        ctx.add_label(child_item)
+
+        return True
+
+
+class BlockedStage(Stage):
+    """Removes the labels of blocked items and their children."""
+
+    name = 'blocked'
+
+    @staticmethod
+    def enabled(ctx):
+        return ctx.label_id is not None and ctx.blocked_label_id is not None
+
+    def run(self, item):
+        ctx = self.ctx
+        if ctx.blocked_label_id in item.labels:
+            ctx.remove_label(item)
+            [ctx.remove_label(child_item) for child_item in ctx.child_items]
+            return False
+        return True
+
+
+class HideFutureStage(Stage):
+    """Removes the label of items that are due too far in the future."""
+
+    name = 'hide_future'
+
+    @staticmethod
+    def enabled(ctx):
+        return ctx.label_id is not None and ctx.args.hide_future > 0
+
+    def run(self, item):
+        ctx = self.ctx
         try:
-            if item['r_tag'] == 1:
-                item.update(checked=0)
-                item.update(in_history=0)
-                item['r_tag'] = 0
-                api.items.update(item['id'])
-
-                for child_item in child_items_all:
-                    child_item['r_tag'] = 1
+            if item.due is not None:
+                due_date = date_ordinal(item.due['date'])
+                if due_date - ctx.clock.today > ctx.args.hide_future:
+                    ctx.remove_label(item)
+                    ctx.wake_at(due_date - ctx.args.hide_future)
+                    return False
         except:
-            # logging.debug('Child not recurring: %s' %
-            #               item['content'])
+            # Malformed due date, skip
+            return False
+        return True
+
+
+class StartStage(Stage):
+    """Removes the labels of items of which the start date has not passed yet."""
+
+    name = 'start'
+
+    @staticmethod
+    def enabled(ctx):
+        return ctx.label_id is not None
+
+    def run(self, item):
+        ctx = self.ctx
+        today = ctx.clock.today
+
+        # Determine the start rule of the item, skip if malformed
+        start_rule = parse_start_rule(ctx.args, item.description, item.content)
+        if start_rule is None:
+            return True
+        if start_rule is invalid_start_rule:
+            return False
+
+        # If start-date has not passed yet, remove label
+        if start_rule.kind == 'date':
+            if today < start_rule.date:
+                ctx.remove_label(item)
+                [ctx.remove_label(child_item)
+                 for child_item in ctx.child_items]
+                ctx.wake_at(start_rule.date)
+                return False
+
+        # Recurring task friendly - remove label with relative change from due date
+        if start_rule.kind == 'due':
+            try:
+                # Ignore time when calculating start date compared to current date
+                item_due_date = date_ordinal(item.due['date'])
+            except:
+                logging.warning(
+                    'No due date to determine start date for item: "%s".', item.content)
+                return False
+
+            # If we're not in the offset from the due date yet, remove all labels
+            if today < item_due_date - start_rule.offset:
+                ctx.remove_label(item)
+                [ctx.remove_label(child_item)
+                 for child_item in ctx.child_items]
+                ctx.wake_at(item_due_date - start_rule.offset)
+                return False
+
+        return True
+
+# Run the enabled stages in a fixed order for every item
+
+
+class RulePipeline(object):
+    """Runs the enabled stages for an item until one of them stops, and reports on them."""
+
+    stage_classes = [HeaderStage, RecurringStage, ActionableStage,
+                     TypeStage, NextActionStage, BlockedStage, HideFutureStage, StartStage]
+
+    # Only a sample of the items is timed, as timing every stage of every
+    # item would take a noticeable part of the evaluation itself
+    sample_every = 8
+
+    def __init__(self, ctx):
+        self.stages = [x(ctx) for x in self.stage_classes if x.enabled(ctx)]
+        self.items = 0
+        self.skipped = 0
+
+    def run(self, item):
+        sampled = self.items % self.sample_every == 0
+        self.items += 1
+
+        if sampled:
+            self.run_timed(item)
+            return
+
+        for stage in self.stages:
+            if not stage.run(item):
+                stage.stops += 1
+                return
+
+    def run_timed(self, item):
+        t0 = time.perf_counter()
+        for stage in self.stages:
+            proceed = stage.run(item)
+            t1 = time.perf_counter()
+            stage.sampled += 1
+            stage.seconds += t1 - t0
+            t0 = t1
+            if not proceed:
+                stage.stops += 1
+                return
+
+    def stats(self):
+        return self.items, self.skipped, [(x.stops, x.sampled, x.seconds) for x in self.stages]
+
+    def merge(self, stats):
+        """Adds the counts and timings of a pipeline that ran in a worker process."""
+        items, skipped, stages = stats
+        self.items += items
+        self.skipped += skipped
+        for stage, (stops, sampled, seconds) in zip(self.stages, stages):
+            stage.stops += stops
+            stage.sampled += sampled
+            stage.seconds += seconds
+
+    def report(self):
+        """Logs and counts the items handled and the estimated time per stage."""
+        handled = self.items
+        for stage in self.stages:
+            if stage.sampled:
+                seconds = stage.seconds * handled / stage.sampled
+            else:
+                seconds = 0.0
+
+            logging.debug('Stage %s handled %d item(s) in %.3f seconds',
+                          stage.name, handled, seconds)
+            metrics.inc('autodoist_stage_items_total', handled, stage.name)
+            metrics.inc('autodoist_stage_seconds_total', seconds, stage.name)
+
+            # Items stopped by this stage never reach the next ones
+            handled -= stage.stops
+
+        logging.debug('Skipped %d item(s) in unchanged trees', self.skipped)
+        metrics.inc('autodoist_items_skipped_total', self.skipped)
+
+# Evaluate all rules for the projects in a snapshot
+
+
+def evaluate_projects(args, api, label_id, blocked_label_id, regen_labels_id, project_ids, clock, state, evaluator=None):
+
+    # Use the same point in time for all date based rules
+    if clock is None:
+        clock = take_clock()
+
+    # Without a persistent store, bookkeeping only lasts for this cycle
+    if state is None:
+        state = StateStore()
+
+    # Copy the projects to evaluate into records, grouped per project and section.
+    # Worker processes create the records of their projects themselves.
+    if evaluator is None:
+        snapshot = Snapshot(api, project_ids)
+    else:
+        snapshot = Snapshot()
+    writer = WriteBack(snapshot)
+
+    ctx = RuleContext(args, state, writer, snapshot, clock,
+                      label_id, blocked_label_id, regen_labels_id)
+    pipeline = RulePipeline(ctx)
+
+    if evaluator is None:
+        for project in snapshot.projects:
+            evaluate_project(ctx, pipeline, snapshot, project)
+    else:
+        evaluate_in_parallel(ctx, pipeline, snapshot,
+                             api, project_ids, evaluator)
+
+    # Keep the models in line with the label updates that will be queued
+    writer.write_labels(ctx.overview_item_labels)
+
+    pipeline.report()
+
+    return ctx.overview_item_ids, ctx.overview_item_labels
+
+# Evaluate all sections and items of a single project
+
+
+def evaluate_project(ctx, pipeline, snapshot, project):
+    args = ctx.args
+    state = ctx.state
+    label_id = ctx.label_id
+
+    # To determine if a sequential task was found
+    ctx.first_found_project = False
+
+    # To determine when date based rules change their outcome
+    ctx.project_wake_day = None
+
+    # Check if we need to (un)header entire project
+    ctx.project_job = check_header(args, state, project)
+    ctx.header_items = set()
+
+    if label_id is not None:
+        # Get project type
+        project_type, project_type_changed = get_project_type(
+            args, state, project)
+        if ctx.debug and project_type is not None:
+            logging.debug('Identified \'%s\' as %s type',
+                          project.name, project_type)
+    else:
+        project_type, project_type_changed = None, 0
+    ctx.project_type = project_type
+
+    # Get all sections and items for the project
+    project_index = snapshot.index[project.id]
+    project_items = project_index['items']
+
+    # Trees that changed nothing in the previous evaluation, until the day
+    # on which their date based rules change their outcome
+    cached_trees = state.trees.get(project.id, {})
+    trees = {}
+    today = ctx.clock.today
+
+    # Run for both none-sectioned and sectioned items
+    for sections in [[create_none_section()], project_index['sections']]:
+        for section in sections:
+
+            # Check if we need to (un)header entire secion
+            ctx.section_job = check_header(args, state, section)
+
+            # To determine if a sequential task was found
+            ctx.first_found_section = False
+
+            # Get section type
+            section_type, section_type_changed = get_section_type(
+                args, state, section)
+            if ctx.debug and section_type is not None:
+                logging.debug('Identified \'%s\' as %s type',
+                              section.name, section_type)
+            ctx.section_type = section_type
+
+            # Get all items for the section, sorted by parent_id
+            items = sorted(project_items.get(section.id, []), key=lambda x: (
+                x.parent_id, x.child_order))
+
+            # If a type has changed, clean label for good measure
+            cleaned = False
+            if label_id is not None:
+                if project_type_changed == 1 or section_type_changed == 1:
+                    # Remove labels
+                    [ctx.remove_label(item) for item in items]
+                    # Remove parent types
+                    for item in items:
+                        state.set('parent_type', item.id, None)
+                    cleaned = True
+
+            # Evaluate tree by tree, so every tree is evaluated in one go
+            item_ids = set(x.id for x in items)
+            children = {}
+            roots = []
+            for item in items:
+                if item.parent_id in item_ids:
+                    try:
+                        children[item.parent_id].append(item)
+                    except KeyError:
+                        children[item.parent_id] = [item]
+                else:
+                    roots.append(item)
+
+            context = (section.id, ctx.project_type, ctx.section_type)
+
+            # After a clean up the labels no longer match the fingerprints, and
+            # running header jobs depend on what was done before
+            cacheable = not cleaned and ctx.project_job is None and ctx.section_job is None
+
+            for root in roots:
+                tree = walk_tree(root, children)
+                ctx.tree_wake_day = None
+
+                if not cacheable:
+                    evaluate_tree(ctx, pipeline, tree)
+                    continue
+
+                key = fingerprint_tree(ctx, context, tree, children)
+                entry = cached_trees.get(root.id)
+                if key is not None and entry is not None and entry[0] == key and (
+                        entry[3] is None or entry[3] > today):
+                    ctx.first_found_section, ctx.first_found_project = entry[1:3]
+                    if entry[3] is not None:
+                        ctx.wake_at(entry[3])
+                    trees[root.id] = entry
+                    pipeline.skipped += len(tree)
+                    continue
+
+                writes = ctx.writer.writes + state.writes
+                labelled = len(ctx.overview_item_ids)
+                evaluate_tree(ctx, pipeline, tree)
+
+                # Only trees that changed nothing give the same result next time
+                if key is None or ctx.writer.writes + state.writes != writes:
+                    continue
+                if len(ctx.overview_item_ids) != labelled and not labels_unchanged(ctx, tree, key):
+                    continue
+                trees[root.id] = (key, ctx.first_found_section,
+                                  ctx.first_found_project, ctx.tree_wake_day)
+
+            if ctx.section_job is not None:
+                ctx.section_job.finish(ctx.writer, state)
+
+    if ctx.project_job is not None:
+        ctx.project_job.finish(ctx.writer, state)
+
+    state.trees[project.id] = trees
+    state.triggers.set(project.id, ctx.project_wake_day)
+
+# List an item and all its descendants, each parent before its children
+
+
+def walk_tree(root, children):
+    tree = []
+    stack = [root]
+    while stack:
+        item = stack.pop()
+        tree.append(item)
+        try:
+            stack.extend(reversed(children[item.id]))
+        except KeyError:
             pass
+    return tree
 
-# Contains all main autodoist functionalities
 
+def evaluate_tree(ctx, pipeline, tree):
+    for item in tree:
+        # Determine which child_items have not been checked yet
+        ctx.child_items = ctx.unchecked_child_map.get(item.id, [])
+        ctx.active_type = None
+
+        pipeline.run(item)
+
+# Fingerprint an item tree from everything its evaluation reads
+
+
+tree_fields = ['item_type', 'parent_type', 'date_old']
+header_prefixes = ('** ', '!* ')
+absent = object()
+
+
+def fingerprint_tree(ctx, context, tree, children):
+    """Returns the fingerprint of a tree, or None if it reads items outside the tree."""
+    child_map = ctx.child_map
+    item_types, parent_types, dates_old = ctx.tree_values
+
+    key = [context, ctx.first_found_section, ctx.first_found_project]
+    for item in tree:
+        item_id = item.id
+
+        # Children in other sections are evaluated there, but read here
+        if len(child_map.get(item_id, ())) != len(children.get(item_id, ())):
+            return None
+
+        # Header jobs of items depend on what was done before
+        if item.content[:3] in header_prefixes:
+            return None
+
+        due = item.due
+        if due is not None:
+            due = (due.get('date'), due.get('is_recurring'))
+
+        key.append((item_id, item.parent_id, item.content, item.checked, item.child_order,
+                    tuple(item.labels), item.description, due,
+                    item_types.get(item_id, absent), parent_types.get(item_id, absent),
+                    dates_old.get(item_id, absent)))
+
+    return tuple(key)
+
+
+def labels_unchanged(ctx, tree, key):
+    """Checks that labels removed and added again left every item as it was."""
+    overview_item_ids = ctx.overview_item_ids
+    for item, fields in zip(tree, key[3:]):
+        item_id = str(item.id)
+        if item_id in overview_item_ids:
+            if overview_item_ids[item_id] != 0 or tuple(item.labels) != fields[5]:
+                return False
+    return True
+
+# Evaluate projects in worker processes, and merge the results in project order
+
+
+def split_projects(projects, sizes, num_chunks):
+    """Divides the projects over chunks with about the same number of items."""
+    chunks = [[] for _ in range(num_chunks)]
+    chunk_sizes = [0] * num_chunks
+    for project in sorted(projects, key=lambda x: sizes[x['id']], reverse=True):
+        i = chunk_sizes.index(min(chunk_sizes))
+        chunks[i].append(project)
+        chunk_sizes[i] += sizes[project['id']]
+
+    return [x for x in chunks if x]
+
+
+def evaluate_in_parallel(ctx, pipeline, snapshot, api, project_ids, evaluator):
+    # Group the models of the projects to evaluate, keeping the order of the state
+    project_models = [x for x in api.state['projects']
+                      if project_ids is None or x.data['id'] in project_ids]
+    section_models = {x.data['id']: [] for x in project_models}
+    item_models = {x.data['id']: [] for x in project_models}
+    for groups, key in [(section_models, 'sections'), (item_models, 'items')]:
+        for model in api.state[key]:
+            group = groups.get(model.data['project_id'])
+            if group is not None:
+                group.append(model)
+
+    # Only the models of these projects receive the updates of the workers
+    snapshot.add_models(project_models, [x for v in section_models.values() for x in v],
+                        [x for v in item_models.values() for x in v])
+
+    projects = [x.data for x in project_models]
+    sections = {k: [x.data for x in v] for k, v in section_models.items()}
+    items = {k: [x.data for x in v] for k, v in item_models.items()}
+
+    # Leave out the caches kept on the options, the workers keep their own
+    args = copy.copy(ctx.args)
+    for name in ['name_classifier', 'description_parser']:
+        args.__dict__.pop(name, None)
+
+    sizes = {x['id']: 1 + len(items[x['id']]) for x in projects}
+    futures = []
+    for chunk in split_projects(projects, sizes, args.eval_processes * 2):
+        chunk_sections = [x for p in chunk for x in sections[p['id']]]
+        chunk_items = [x for p in chunk for x in items[p['id']]]
+        object_ids = [x['id'] for x in chunk] + [x['id'] for x in chunk_sections] + \
+            [x['id'] for x in chunk_items]
+
+        futures.append(evaluator.submit(evaluate_chunk, args, ctx.clock, ctx.label_id, ctx.blocked_label_id,
+                                        ctx.regen_labels_id, logging.root.level, chunk, chunk_sections,
+                                        chunk_items, ctx.state.subset(object_ids)))
+
+    results = {}
+    for future in futures:
+        for result in future.result():
+            results[result[0]] = result
+
+    # Merge in the same order as a serial evaluation, so the queue is identical
+    for project in projects:
+        _, overview_item_ids, overview_item_labels, updates, changes, wake_day, records, stats = results[
+            project['id']]
+
+        for record in records:
+            logging.getLogger(record.name).handle(record)
+
+        ctx.overview_item_ids.update(overview_item_ids)
+        ctx.overview_item_labels.update(overview_item_labels)
+        ctx.writer.apply(updates)
+        ctx.state.apply(changes)
+        ctx.state.triggers.set(project['id'], wake_day)
+        pipeline.merge(stats)
+
+# Keep the log records of a worker process, to log them in the main process
+
+
+class RecordCollector(logging.Handler):
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        # Arguments and exceptions may not survive the trip to the main process
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        self.records.append(record)
 
-def autodoist_magic(args, api, label_id, blocked_label_id, regen_labels_id):
+    def take(self):
+        records = self.records
+        self.records = []
+        return records
 
-    # Preallocate dictionaries
-    overview_item_ids = {}
-    overview_item_labels = {}
 
-    for project in api.projects.all():
+worker_state = {}
 
-        # To determine if a sequential task was found
-        first_found_project = False
 
-        # Check if we need to (un)header entire project
-        header_all_in_p, unheader_all_in_p = check_header(project)
+def evaluate_chunk(args, clock, label_id, blocked_label_id, regen_labels_id, log_level, projects, sections, items, values):
+    """Evaluates a chunk of projects in a worker process."""
 
+    # Reuse the options of the previous chunk, with the caches kept on them
+    if worker_state.get('options') != vars(args):
+        worker_state['options'] = dict(vars(args))
+        worker_state['args'] = args
+    args = worker_state['args']
+
+    if 'collector' not in worker_state:
+        worker_state['collector'] = RecordCollector()
+        logging.getLogger().addHandler(worker_state['collector'])
+    collector = worker_state['collector']
+    logging.getLogger().setLevel(log_level)
+
+    # Keep the trees of the projects this worker evaluated in its previous
+    # cycle, as projects move between the workers from cycle to cycle
+    if worker_state.get('cycle') != clock.now:
+        worker_state['cycle'] = clock.now
+        evaluated = worker_state.get('evaluated', set())
+        worker_state['trees'] = {k: v for k, v in worker_state.get('trees', {}).items()
+                                 if k in evaluated}
+        worker_state['evaluated'] = set()
+    worker_state['evaluated'].update(x['id'] for x in projects)
+
+    state = StateStore()
+    state.values = values
+    state.trees = worker_state['trees']
+
+    results = []
+    with gc_paused():
+        snapshot = Snapshot()
+        snapshot.build(projects, sections, items)
+        writer = WriteBack(snapshot)
+
+        for project in snapshot.projects:
+            ctx = RuleContext(args, state, writer, snapshot, clock,
+                              label_id, blocked_label_id, regen_labels_id)
+            pipeline = RulePipeline(ctx)
+            evaluate_project(ctx, pipeline, snapshot, project)
+
+            results.append((project.id, ctx.overview_item_ids, ctx.overview_item_labels, writer.take_updates(),
+                            state.take_changes(), ctx.project_wake_day, collector.take(), pipeline.stats()))
+
+    return results
+
+# Save the synced state to a file for offline replay
+
+
+snapshot_models = [('projects', models.Project), ('sections', models.Section),
+                   ('items', models.Item), ('labels', models.Label)]
+
+
+def save_snapshot(api, state, path):
+    snapshot = {key: [x.data for x in api.state[key]]
+                for key, _ in snapshot_models}
+    snapshot['autodoist_state'] = state.dump()
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(snapshot, f, separators=(',', ':'))
+    logging.info('Snapshot of %d items saved to %s',
+                 len(snapshot['items']), path)
+
+# Load a saved state into an offline API instance
+
+
+def load_snapshot(path):
+    with open(path, encoding='utf-8') as f:
+        snapshot = json.load(f)
+
+    api = TodoistAPI(cache=None)
+    for key, model in snapshot_models:
+        api.state[key] = [model(x, api) for x in snapshot.get(key, [])]
+
+    state = StateStore()
+    state.import_models(api)
+    state.load(snapshot.get('autodoist_state', []))
+
+    return api, state
+
+# Find the label ids in an offline state, without creating missing labels
+
+
+def find_label_ids(args, api):
+    label_ids = {x['name']: x['id'] for x in api.state['labels']}
+
+    names = []
+    if args.label is not None:
+        names.append(args.label)
+        if args.blocked_label is not None:
+            names.append(args.blocked_label)
+    if args.regeneration is not None:
+        names += list(args.regen_label_names)
+
+    missing = [x for x in names if x not in label_ids]
+    if missing:
+        raise KeyError('Label(s) not found: {}'.format(', '.join(missing)))
+
+    if args.label is not None:
+        label_id = label_ids[args.label]
+        blocked_label_id = label_ids.get(args.blocked_label)
+    else:
+        label_id = None
+        blocked_label_id = None
+
+    if args.regeneration is not None:
+        regen_labels_id = [label_ids[x] for x in args.regen_label_names]
+    else:
+        regen_labels_id = [None, None, None]
+
+    return label_id, blocked_label_id, regen_labels_id
+
+# Run all rules against saved states and output the resulting commands
+
+
+def replay_snapshots(args, paths):
+    start_time = time.perf_counter()
+    num_snapshots = 0
+    num_commands = 0
+    evaluator = create_evaluator(args)
+
+    for path in paths:
+        try:
+            api, state = load_snapshot(path)
+            label_id, blocked_label_id, regen_labels_id = find_label_ids(
+                args, api)
+        except (OSError, ValueError, KeyError) as e:
+            logging.error('Could not replay snapshot %s: %s', path, e)
+            continue
+
+        overview_item_ids, overview_item_labels = autodoist_magic(
+            args, api, label_id, blocked_label_id, regen_labels_id, state=state, evaluator=evaluator)
         if label_id is not None:
-            # Get project type
-            project_type, project_type_changed = get_project_type(
-                args, project)
-            if project_type is not None:
-                logging.debug('Identified \'%s\' as %s type',
-                            project['name'], project_type)
-
-        # Get all items for the project
-        project_items = api.items.all(
-            lambda x: x['project_id'] == project['id'])
-
-        # Run for both none-sectioned and sectioned items
-        for s in [0, 1]:
-            if s == 0:
-                sections = [create_none_section()]
-            elif s == 1:
-                sections = api.sections.all(
-                    lambda x: x['project_id'] == project['id'])
-
-            for section in sections:
-
-                # Check if we need to (un)header entire secion
-                header_all_in_s, unheader_all_in_s = check_header(section)
-
-                # To determine if a sequential task was found
-                first_found_section = False
-
-                # Get section type
-                section_type, section_type_changed = get_section_type(
-                    args, section)
-                if section_type is not None:
-                    logging.debug('Identified \'%s\' as %s type',
-                                section['name'], section_type)
-
-                # Get all items for the section
-                items = [x for x in project_items if x['section_id']
-                         == section['id']]
-
-                # Change top parents_id in order to sort later on
-                for item in items:
-                    if not item['parent_id']:
-                        item['parent_id'] = 0
-
-                # Sort by parent_id and filter for completable items
-                items = sorted(items, key=lambda x: (
-                    x['parent_id'], x['child_order']))
-
-                # If a type has changed, clean label for good measure
-                if label_id is not None:
-                    if project_type_changed == 1 or section_type_changed == 1:
-                        # Remove labels
-                        [remove_label(item, label_id, overview_item_ids,
-                                      overview_item_labels) for item in items]
-                        # Remove parent types
-                        for item in items:
-                            item['parent_type'] = None
-
-                # For all items in this section
-                for item in items:
-                    active_type = None  # Reset
-
-                    # Possible nottes routine for the future
-                    # notes = api.notes.all() TODO: Quick notes test to see what the impact is?
-                    # note_content = [x['content'] for x in notes if x['item_id'] == item['id']]
-                    # print(note_content)
-
-                    # Determine which child_items exist, both all and the ones that have not been checked yet
-                    non_checked_items = list(
-                        filter(lambda x: x['checked'] == 0, items))
-                    child_items_all = list(
-                        filter(lambda x: x['parent_id'] == item['id'], items))
-                    child_items = list(
-                        filter(lambda x: x['parent_id'] == item['id'], non_checked_items))
-
-                    # Check if we need to (un)header entire item tree
-                    header_all_in_i, unheader_all_in_i = check_header(item)
-
-                    # Logic for applying and removing headers
-                    if any([header_all_in_p, header_all_in_s, header_all_in_i]):
-                        if item['content'][0] != '*':
-                            item.update(content='* ' + item['content'])
-                            for ci in child_items:
-                                if not ci['content'].startswith('*'):
-                                    ci.update(content='* ' + ci['content'])
-
-                    if any([unheader_all_in_p, unheader_all_in_s]):
-                        if item['content'][0] == '*':
-                            item.update(content=item['content'][2:])
-                    if unheader_all_in_i:
-                        [ci.update(content=ci['content'][2:])
-                         for ci in child_items]
-
-                    # Logic for recurring lists
-                    if not args.regeneration:
-                        try:
-                            # If old label is present, reset it
-                            if item['r_tag'] == 1:
-                                item['r_tag'] = 0
-                                api.items.update(item['id'])
-                        except:
-                            pass
-
-                    # If options turned on, start recurring lists logic
-                    if args.regeneration is not None or args.end:
-                        run_recurring_lists_logic(
-                            args, api, item, child_items, child_items_all, regen_labels_id)
-
-                    # If options turned on, start labelling logic
-                    if label_id is not None:
-                        # Skip processing an item if it has already been checked or is a header
-                        if item['checked'] == 1:
-                            continue
-                        if item['content'].startswith('*'):
-                            # Remove next action label if it's still present
-                            remove_label(item, label_id, overview_item_ids,overview_item_labels)
-                            continue
-
-                        # Check item type
-                        item_type, item_type_changed = get_item_type(
-                            args, item, project_type)
-                        if item_type is not None:
-                            logging.debug('Identified \'%s\' as %s type',
-                                        item['content'], item_type)
-
-                        # Determine hierarchy types for logic
-                        hierarchy_types = [item_type,
-                                           section_type, project_type]
-                        active_types = [type(x) != type(None)
-                                        for x in hierarchy_types]
-
-                        # If it is a parentless task
-                        if item['parent_id'] == 0:
-                            if active_types[0]:
-                                # Do item types
-                                active_type = item_type
-                                add_label(
-                                    item, label_id, overview_item_ids, overview_item_labels)
-
-                            elif active_types[1]:
-                                # Do section types
-                                active_type = section_type
-
-                                if section_type == 'sequential' or section_type == 's-p':
-                                    if not first_found_section:
-                                        add_label(
-                                            item, label_id, overview_item_ids, overview_item_labels)
-                                        first_found_section = True
-                                    else:
-                                        remove_label(
-                                            item, label_id, overview_item_ids, overview_item_labels)
-                                elif section_type == 'parallel' or section_type == 'p-s':
-                                    add_label(
-                                        item, label_id, overview_item_ids, overview_item_labels)
-
-                            elif active_types[2]:
-                                # Do project types
-                                active_type = project_type
-
-                                if project_type == 'sequential' or project_type == 's-p':
-                                    if not first_found_project:
-                                        add_label(
-                                            item, label_id, overview_item_ids, overview_item_labels)
-                                        first_found_project = True
-                                    else:
-                                        remove_label(
-                                            item, label_id, overview_item_ids, overview_item_labels)
-
-                                elif project_type == 'parallel' or project_type == 'p-s':
-                                    add_label(
-                                        item, label_id, overview_item_ids, overview_item_labels)
-
-                            # Mark other conditions too
-                            if first_found_section == False and active_types[1]:
-                                first_found_section = True
-                            if first_found_project is False and active_types[2]:
-                                first_found_project = True
-
-                        # If there are children
-                        if len(child_items) > 0:
-                            # Check if item state has changed, if so clean children for good measure
-                            if item_type_changed == 1:
-                                [remove_label(child_item, label_id, overview_item_ids, overview_item_labels)
-                                    for child_item in child_items]
-
-                            # If a sub-task, inherit parent task type
-                            if item['parent_id'] !=0:
-                                try:
-                                    active_type = item['parent_type']      
-                                except:
-                                    pass 
-                            
-                            # Process sequential tagged items (item_type can overrule project_type)
-                            if active_type == 'sequential' or active_type == 'p-s':
-                                for child_item in child_items:
-                                    
-                                    # Ignore headered children
-                                    if child_item['content'].startswith('*'):
-                                        continue
-
-                                    # Pass item_type down to the children
-                                    child_item['parent_type'] = active_type
-                                    # Pass label down to the first child
-                                    if child_item['checked'] == 0 and label_id in item['labels']:
-                                        add_label(
-                                            child_item, label_id, overview_item_ids, overview_item_labels)
-                                        remove_label(
-                                            item, label_id, overview_item_ids, overview_item_labels)
-                                    else:
-                                        # Clean for good measure
-                                        remove_label(
-                                            child_item, label_id, overview_item_ids, overview_item_labels)
-
-                            # Process parallel tagged items or untagged parents
-                            elif active_type == 'parallel' or (active_type == 's-p' and label_id in item['labels']):
-                                remove_label(
-                                    item, label_id, overview_item_ids, overview_item_labels)
-                                for child_item in child_items:
-
-                                    # Ignore headered children
-                                    if child_item['content'].startswith('*'):
-                                        continue
-
-                                    child_item['parent_type'] = active_type
-                                    if child_item['checked'] == 0:
-                                        # child_first_found = True
-                                        add_label(
-                                            child_item, label_id, overview_item_ids, overview_item_labels)
-                        
-                        # Check for blocked tag
-                        try:
-                            if blocked_label_id in item['labels']:
-                                remove_label(
-                                    item, label_id, overview_item_ids, overview_item_labels)
-                                [remove_label(child_item, label_id, overview_item_ids,
-                                              overview_item_labels) for child_item in child_items]
-                                continue
-                        except:
-                            continue
-
-                        # Remove labels based on start / due dates
-
-                        # If item is too far in the future, remove the next_action tag and skip
-                        try:
-                            if args.hide_future > 0 and 'due' in item.data and item['due'] is not None:
-                                due_date = datetime.strptime(
-                                    item['due']['date'], "%Y-%m-%d")
-                                future_diff = (
-                                    due_date - datetime.today()).days
-                                if future_diff >= args.hide_future:
-                                    remove_label(
-                                        item, label_id, overview_item_ids, overview_item_labels)
-                                    continue
-                        except:
-                            # Hide-future not set, skip
-                            continue
-
-                        # If start-date has not passed yet, remove label
-                        try:
-                            f1 = item['description'].find('start=')
-                            f2 = item['description'].find('start=due-')
-                            if f1 > -1 and f2 == -1:
-                                f_end = item['description'][f1+6:].find(' ')
-                                if f_end > -1:
-                                    start_date = item['description'][f1 +
-                                                                 6:f1+6+f_end]
-                                else:
-                                    start_date = item['description'][f1+6:]
-
-                                # If start-date hasen't passed, remove all labels
-                                start_date = datetime.strptime(
-                                    start_date, args.dateformat)
-                                future_diff = (
-                                    datetime.today()-start_date).days
-                                if future_diff < 0:
-                                    remove_label(
-                                        item, label_id, overview_item_ids, overview_item_labels)
-                                    [remove_label(child_item, label_id, overview_item_ids,
-                                                  overview_item_labels) for child_item in child_items]
-                                    continue
-
-                        except:
-                            logging.warning(
-                                'Wrong start-date format for item: "%s". Please use "start=%s"', item['content'], args.dateformat)
-                            continue
-
-                        # Recurring task friendly - remove label with relative change from due date
-                        try:
-                            f = item['description'].find('start=due-')
-                            if f > -1:
-                                f1a = item['description'].find(
-                                    'd')  # Find 'd' from 'due'
-                                f1b = item['description'].rfind(
-                                    'd')  # Find 'd' from days
-                                f2 = item['description'].find('w')
-                                f_end = item['description'][f+10:].find(' ')
-
-                                if f_end > -1:
-                                    offset = item['description'][f+10:f+10+f_end-1]
-                                else:
-                                    offset = item['description'][f+10:-1]
-
-                                try:
-                                    # item_due_date = item['due']['date']
-                                    # Ignore time when calculating start date compared to current date
-                                    item_due_date = item['due']['date'][0:10]
-                                    item_due_date = datetime.strptime(
-                                        item_due_date, '%Y-%m-%d')
-                                except:
-                                    logging.warning(
-                                        'No due date to determine start date for item: "%s".', item['content'])
-                                    continue
-
-                                if f1a != f1b and f1b > -1:  # To make sure it doesn't trigger if 'w' is chosen
-                                    td = timedelta(days=int(offset))
-                                elif f2 > -1:
-                                    td = timedelta(weeks=int(offset))
-
-                                # If we're not in the offset from the due date yet, remove all labels
-                                start_date = item_due_date - td
-                                future_diff = (
-                                    datetime.today()-start_date).days
-                                if future_diff < 0:
-                                    remove_label(
-                                        item, label_id, overview_item_ids, overview_item_labels)
-                                    [remove_label(child_item, label_id, overview_item_ids,
-                                                  overview_item_labels) for child_item in child_items]
-                                    continue
-
-                        except:
-                            logging.warning(
-                                'Wrong start-date format for item: %s. Please use "start=due-<NUM><d or w>"', item['content'])
-                            continue
-
-    return overview_item_ids, overview_item_labels
+            update_labels(api, label_id, overview_item_ids,
+                          overview_item_labels)
+
+        # Leave out the random uuids, so the output is deterministic
+        commands = [{'type': x['type'], 'args': x['args']} for x in api.queue]
+        num_snapshots += 1
+        num_commands += len(commands)
+
+        sys.stdout.write(json.dumps(
+            {'snapshot': path, 'commands': commands}, default=str) + '\n')
+
+    logging.info('Replayed %d snapshot(s) into %d command(s) in %.3f seconds',
+                 num_snapshots, num_commands, time.perf_counter() - start_time)
+
+# Run a single sync, evaluate, and commit cycle
+
+
+def run_cycle(args, api, state, label_id, blocked_label_id, regen_labels_id, tracker=None, pipeline=None, evaluator=None):
+    t0 = time.perf_counter()
+    response = sync(api)
+    metrics.observe('autodoist_sync_seconds', time.perf_counter() - t0)
+
+    # Let the commit of the previous cycle finish, which ran next to the sync
+    if pipeline is not None:
+        pipeline.wait()
+        if pipeline.failed:
+            pipeline.failed = False
+            response = resync(api)
+
+    # Use the same point in time for the triggers and all date based rules
+    clock = take_clock()
+
+    # Date based rules of these projects changed their outcome since the previous cycle
+    due_project_ids = state.triggers.take(clock.today)
+    if due_project_ids:
+        logging.debug('Date based rules changed in %d project(s)',
+                      len(due_project_ids))
+
+    # Determine which projects changed
+    if tracker is not None:
+        tracker.mark(due_project_ids)
+        project_ids = tracker.changed_projects(api, response, pipeline)
+    else:
+        project_ids = None
+
+    # Evaluate projects, sections, and items
+    t0 = time.perf_counter()
+    overview_item_ids, overview_item_labels = autodoist_magic(
+        args, api, label_id, blocked_label_id, regen_labels_id, project_ids, clock, state, evaluator)
+    metrics.observe('autodoist_evaluate_seconds', time.perf_counter() - t0)
+
+    # Commit the queue with changes
+    if label_id is not None:
+        t0 = time.perf_counter()
+        update_labels(api, label_id, overview_item_ids,
+                      overview_item_labels)
+        metrics.observe('autodoist_update_labels_seconds',
+                        time.perf_counter() - t0)
+
+        metrics.inc('autodoist_labels_added_total', len(
+            [v for v in overview_item_ids.values() if v > 0]))
+        metrics.inc('autodoist_labels_removed_total', len(
+            [v for v in overview_item_ids.values() if v < 0]))
+
+    if tracker is not None:
+        tracker.track_queue(api)
+
+    len_api_q = len(api.queue)
+    metrics.observe('autodoist_queue_length', len_api_q)
+    if len_api_q and pipeline is not None:
+        pipeline.submit(api)
+    elif len_api_q:
+        t0 = time.perf_counter()
+        committed = commit_queue(
+            api, args.batch_size, args.retries, tracker)
+        metrics.observe('autodoist_commit_seconds', time.perf_counter() - t0)
+        metrics.inc('autodoist_commands_committed_total', committed)
+        if committed < len_api_q:
+            sync_response = resync(api)
+            if tracker is not None:
+                tracker.track_response(sync_response)
+
+    # Persist the bookkeeping of this cycle
+    state.flush()
+
+    metrics.inc('autodoist_cycles_total')
+
+    changed = sync_has_changes(response) or len_api_q > 0
+
+    return changed, len_api_q
+
+# Create the change tracker and scheduler for the chosen modes
+
+
+def create_tracker(args):
+    if args.incremental:
+        return ChangeTracker(args.full_sweep)
+    return None
+
+
+def create_pipeline(args):
+    if args.pipeline:
+        return CommitPipeline(args.batch_size, args.retries)
+    return None
+
+
+def create_evaluator(args):
+    if args.eval_processes > 1:
+        # Fresh processes, as forking next to the logging and server threads is unsafe
+        return ProcessPoolExecutor(max_workers=args.eval_processes,
+                                   mp_context=multiprocessing.get_context('spawn'))
+    return None
+
+
+def create_scheduler(args):
+    if args.adaptive:
+        if args.min_delay < 1 or args.max_delay < args.min_delay:
+            logging.error(
+                'Please choose a minimum delay of at least 1 second, and a maximum delay that is not smaller than the minimum delay.')
+            sys.exit(1)
+        return AdaptiveScheduler(args.min_delay, args.max_delay)
+    return None
+
+# A single Todoist account served by the daemon
+
+
+class Account(object):
+    """Holds the connection, label ids, and cycle state of one account."""
+
+    # Seconds to wait before connecting again after a failed connection
+    retry_delay = 300
+
+    def __init__(self, name, args, evaluator=None):
+        self.name = name
+        self.args = args
+        self.evaluator = evaluator
+        self.api = None
+        self.state = None
+        self.label_id = None
+        self.blocked_label_id = None
+        self.regen_labels_id = [None, None, None]
+        self.tracker = create_tracker(args)
+        self.pipeline = create_pipeline(args)
+        self.scheduler = create_scheduler(args)
+        self.next_run = 0
+
+    def connect(self):
+        try:
+            self.api, self.state, self.label_id, self.blocked_label_id, self.regen_labels_id = initialise(
+                self.args)
+        except (Exception, SystemExit) as e:
+            # Never let one account take down the other accounts
+            logging.error('Account \'%s\': could not connect, retrying in %d seconds: %s',
+                          self.name, self.retry_delay, e)
+            self.api = None
+            self.next_run = time.time() + self.retry_delay
+        return self
+
+    def run(self):
+        if self.api is None:
+            return self.connect()
+
+        start_time = time.time()
+        try:
+            changed, len_api_q = run_cycle(self.args, self.api, self.state, self.label_id,
+                                           self.blocked_label_id, self.regen_labels_id, self.tracker,
+                                           self.pipeline, self.evaluator)
+        except (Exception, SystemExit) as e:
+            # Never let one account take down the other accounts
+            logging.error('Account \'%s\': cycle failed: %s', self.name, e)
+            changed, len_api_q = False, 0
+
+        if len_api_q:
+            logging.info('Account \'%s\': %d change(s) committed to Todoist.',
+                         self.name, len_api_q)
+
+        if self.scheduler is not None:
+            delay = self.scheduler.next_delay(changed)
+        else:
+            delay = self.args.delay
+        self.next_run = start_time + \
+            max(wake_delay(self.state, start_time, delay), 0)
+
+        # Waking up early for date based rules is not an overrun
+        if time.time() > start_time + max(delay, 0):
+            metrics.inc('autodoist_cycle_overruns_total')
+
+        return self
+
+# Read the accounts and their options from a config file
+
+
+def load_accounts(args, evaluator=None):
+    try:
+        with open(args.accounts) as f:
+            config = json.load(f)
+    except (OSError, ValueError) as e:
+        logging.error('Could not read accounts file \'%s\': %s', args.accounts, e)
+        sys.exit(1)
+
+    if isinstance(config, dict):
+        config = config.get('accounts', [])
+
+    # Options that only make sense for the daemon as a whole
+    daemon_options = ['accounts', 'workers', 'onetime',
+                      'debug', 'log_size', 'eval_processes']
+
+    # Accounts sharing a store would prune each other's bookkeeping
+    if args.state_file:
+        logging.error(
+            'The --state_file option can only be given per account in %s', args.accounts)
+        sys.exit(1)
+
+    accounts = []
+    for i, options in enumerate(config):
+        account_args = copy.copy(args)
+        name = options.get('name', 'account-{}'.format(i + 1))
+
+        for key, value in options.items():
+            if key == 'name':
+                continue
+            if key in daemon_options or not hasattr(args, key):
+                logging.error(
+                    'Unknown option \'%s\' for account \'%s\' in %s', key, name, args.accounts)
+                sys.exit(1)
+            setattr(account_args, key, value)
+
+        accounts.append(Account(name, account_args, evaluator))
+
+    if not accounts:
+        logging.error('No accounts found in %s', args.accounts)
+        sys.exit(1)
+
+    state_files = [os.path.expanduser(x.args.state_file)
+                   for x in accounts if x.args.state_file]
+    if len(state_files) != len(set(state_files)):
+        logging.error('Accounts in %s can not share a state file', args.accounts)
+        sys.exit(1)
+
+    return accounts
+
+# Serve many accounts from one process on a bounded worker pool
+
+
+def run_daemon(args):
+    # All accounts share the worker processes for the evaluation
+    accounts = load_accounts(args, create_evaluator(args))
+    logging.info('Serving %d accounts with %d workers',
+                 len(accounts), args.workers)
+
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        # Connect all accounts, which runs their initial sync
+        list(pool.map(lambda x: x.connect(), accounts))
+
+        if args.onetime:
+            list(pool.map(lambda x: x.run(), [x for x in accounts if x.api is not None]))
+            for account in accounts:
+                if account.pipeline is not None:
+                    account.pipeline.wait()
+            return
+
+        running = {}
+        while True:
+            now = time.time()
+            busy = set(running.values())
+            for account in accounts:
+                if account not in busy and account.next_run <= now:
+                    running[pool.submit(account.run)] = account
+                    busy.add(account)
+
+            idle = [x.next_run for x in accounts if x not in busy]
+            if idle:
+                timeout = max(min(idle) - time.time(), 0)
+            else:
+                timeout = None
+
+            if running:
+                done, _ = wait(list(running), timeout=timeout,
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    del running[future]
+            elif timeout:
+                time.sleep(timeout)
+
+# Write the log from a background thread, rotating the log file by size
+
+
+def setup_logging(args):
+    if args.debug:
+        log_level = logging.DEBUG
+    else:
+        log_level = logging.INFO
+
+    file_handler = RotatingFileHandler(
+        'debug.log', maxBytes=args.log_size * 1024 * 1024, backupCount=3, encoding='utf-8', delay=True)
+
+    # Start every run with a fresh log, keeping the previous run as a backup
+    if os.path.exists('debug.log') and os.path.getsize('debug.log') > 0:
+        file_handler.doRollover()
+
+    formatter = logging.Formatter('%(asctime)s %(levelname)-8s %(message)s',
+                                  datefmt='%Y-%m-%d %H:%M:%S')
+    handlers = [file_handler, logging.StreamHandler()]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    # Cycles only put records on the queue, the listener does the writing
+    log_queue = queue.Queue(-1)
+    listener = QueueListener(log_queue, *handlers)
+
+    root = logging.getLogger()
+    root.setLevel(log_level)
+    root.addHandler(QueueHandler(log_queue))
+
+    listener.start()
+    atexit.register(listener.stop)
+
+    return listener
 
 # Main
 
@@ -937,6 +3150,20 @@ def main():
         '-e', '--end', help='enable alternative end-of-day time instead of default midnight. Enter a number from 1 to 24 to define which hour is used.', type=int)
     parser.add_argument(
         '-d', '--delay', help='specify the delay in seconds between syncs (default 5).', default=5, type=int)
+    parser.add_argument(
+        '--batch_size', help='maximum number of changes committed per request (default 100).', default=100, type=int)
+    parser.add_argument(
+        '--retries', help='number of times failed changes are retried (default 5).', default=5, type=int)
+    parser.add_argument(
+        '--header_batch', help='maximum number of tasks (un)headered per project, section, or task in one cycle (default 500).', default=500, type=int)
+    parser.add_argument(
+        '--pipeline', help='commit the changes of a cycle while the next cycle syncs.', action='store_true')
+    parser.add_argument(
+        '--adaptive', help='adapt the delay between syncs to recent activity instead of using a fixed delay.', action='store_true')
+    parser.add_argument(
+        '--min_delay', help='minimum delay in seconds between syncs in adaptive mode (default 2).', default=2, type=int)
+    parser.add_argument(
+        '--max_delay', help='maximum delay in seconds between syncs in adaptive mode (default 300).', default=300, type=int)
     parser.add_argument(
         '-pp', '--pp_suffix', help='change suffix for parallel-parallel labeling (default "//").', default='//')
     parser.add_argument(
@@ -949,12 +3176,46 @@ def main():
         '-df', '--dateformat', help='strptime() format of starting date (default "%%d-%%m-%%Y").', default='%d-%m-%Y')
     parser.add_argument(
         '-hf', '--hide_future', help='prevent labelling of future tasks beyond a specified number of days.', default=0, type=int)
+    parser.add_argument(
+        '--eval_processes', help='evaluate the projects in this many parallel processes (default 0, evaluate in the main process).', default=0, type=int)
+    parser.add_argument(
+        '--incremental', help='only evaluate projects that changed since the previous sync.', action='store_true')
+    parser.add_argument(
+        '--full_sweep', help='in incremental mode, also evaluate all projects every so many seconds as a safety net (default 3600).', default=3600, type=int)
+    parser.add_argument(
+        '--accounts', help='serve all accounts and their options from a JSON config file.', type=str)
+    parser.add_argument(
+        '--workers', help='number of accounts that are synced at the same time in multi-account mode (default 4).', default=4, type=int)
+    parser.add_argument(
+        '--metrics_port', help='expose Prometheus metrics on this local port.', default=None, type=int)
+    parser.add_argument(
+        '--metrics_host', help='address the metrics endpoint listens on (default 127.0.0.1).', default='127.0.0.1')
+    parser.add_argument(
+        '--webhook_port', help='receive Todoist webhook events on this port and evaluate only the affected projects.', default=None, type=int)
+    parser.add_argument(
+        '--webhook_host', help='address the webhook receiver listens on (default 127.0.0.1).', default='127.0.0.1')
+    parser.add_argument(
+        '--webhook_secret', help='client secret used to verify the webhook signatures.', default=os.environ.get('TODOIST_CLIENT_SECRET'), type=str)
+    parser.add_argument(
+        '--poll_delay', help='in webhook mode, the delay in seconds between safety-net syncs (default 300).', default=300, type=int)
+    parser.add_argument(
+        '--save_snapshot', help='save the synced state to a file, to replay it later.', metavar='FILE', type=str)
+    parser.add_argument(
+        '--replay', help='evaluate saved states offline and print the resulting commands.', metavar='FILE', nargs='+')
     parser.add_argument(
         '--onetime', help='update Todoist once and exit.', action='store_true')
+    parser.add_argument(
+        '--no_update_check', help='do not check for a newer version of Autodoist.', action='store_true')
     parser.add_argument(
         '--nocache', help='disables caching data to disk for quicker syncing.', action='store_true')
+    parser.add_argument(
+        '--binary_cache', help='cache only the projects, sections, items and labels in a binary file that is updated incrementally.', action='store_true')
+    parser.add_argument(
+        '--state_file', help='file to keep the regeneration history and detected types in (default in ~/.autodoist/).', type=str)
     parser.add_argument('--debug', help='enable debugging and store detailed to a log file.',
                         action='store_true')
+    parser.add_argument(
+        '--log_size', help='maximum size in MB of the log file before it is rotated (default 10).', default=10, type=int)
     parser.add_argument('--inbox', help='the method the Inbox should be processed with.',
                         default=None, choices=['parallel', 'sequential'])
 
@@ -964,65 +3225,104 @@ def main():
     args.regen_label_names = ('Regen_off', 'Regen_all',
                               'Regen_all_if_completed')
 
-    # Set debug
-    if args.debug:
-        log_level = logging.DEBUG
-    else:
-        log_level = logging.INFO
+    # Set up logging
+    setup_logging(args)
+
+    # Replay saved states without connecting to Todoist
+    if args.replay:
+        replay_snapshots(args, args.replay)
+        return
+
+    # Check for updates in the background, so it never delays the start
+    if not args.no_update_check:
+        threading.Thread(target=check_for_update, args=(
+            current_version,), daemon=True).start()
 
-    logging.basicConfig(level=log_level,
-                        format='%(asctime)s %(levelname)-8s %(message)s',
-                        datefmt='%Y-%m-%d %H:%M:%S',
-                        handlers=[logging.FileHandler(
-                            'debug.log', 'w+', 'utf-8'),
-                            logging.StreamHandler()]
-                        )
+    # Expose metrics if needed
+    if args.metrics_port is not None:
+        start_metrics_server(args.metrics_host, args.metrics_port)
 
-    # Check for updates
-    check_for_update(current_version)
+    # Serve multiple accounts if needed
+    if args.accounts:
+        if args.webhook_port is not None:
+            logging.error(
+                'Webhook mode can not be combined with multiple accounts.')
+            sys.exit(1)
+        run_daemon(args)
+        return
 
     # Initialise api
-    api, label_id, blocked_label_id, regen_labels_id = initialise(args)
+    api, state, label_id, blocked_label_id, regen_labels_id = initialise(args)
+
+    # Save the synced state if needed
+    if args.save_snapshot:
+        save_snapshot(api, state, args.save_snapshot)
+
+    # Track changes and adapt the delay between syncs if needed
+    tracker = create_tracker(args)
+    pipeline = create_pipeline(args)
+    scheduler = create_scheduler(args)
+    evaluator = create_evaluator(args)
+
+    # Receive webhook events if needed, which only evaluate the touched projects
+    if args.webhook_port is not None:
+        receiver = start_webhook_server(
+            args.webhook_host, args.webhook_port, args.webhook_secret)
+        if tracker is None:
+            tracker = ChangeTracker(args.full_sweep)
+    else:
+        receiver = None
 
     # Start main loop
     while True:
         start_time = time.time()
-        sync(api)
 
-        # Evaluate projects, sections, and items
-        overview_item_ids, overview_item_labels = autodoist_magic(
-            args, api, label_id, blocked_label_id, regen_labels_id)
-
-        # Commit the queue with changes
-        if label_id is not None:
-            update_labels(api, label_id, overview_item_ids,
-                          overview_item_labels)
+        changed, len_api_q = run_cycle(
+            args, api, state, label_id, blocked_label_id, regen_labels_id, tracker, pipeline, evaluator)
 
-        if len(api.queue):
-            len_api_q = len(api.queue)
-            api.commit()
-            if len_api_q == 1:
-                logging.info(
-                    '%d change committed to Todoist.', len_api_q)
-            else:
-                logging.info(
-                    '%d changes committed to Todoist.', len_api_q)
-        # else:
-            # logging.info('No changes in queue, skipping sync.')
+        if len_api_q == 1:
+            logging.info(
+                '%d change committed to Todoist.', len_api_q)
+        elif len_api_q > 1:
+            logging.info(
+                '%d changes committed to Todoist.', len_api_q)
 
         # If onetime is set, exit after first execution.
         if args.onetime:
+            if pipeline is not None:
+                pipeline.wait()
             break
 
+        # In webhook mode, sync when events arrive, date based rules change, or the safety-net poll is due
+        if receiver is not None:
+            delay = wake_delay(state, start_time, args.poll_delay)
+            if receiver.wait(delay - (time.time() - start_time)):
+                logging.debug('Woken by webhook events')
+            elif delay < args.poll_delay:
+                logging.debug('Woken by date based rules')
+            else:
+                logging.debug('Running the safety-net sync')
+            tracker.mark(receiver.take())
+            continue
+
         # Set a delay before next sync
+        if scheduler is not None:
+            delay = scheduler.next_delay(changed)
+        else:
+            delay = args.delay
+
+        # Wake up earlier if date based rules change in the meantime
+        wake = wake_delay(state, start_time, delay)
+
         end_time = time.time()
         delta_time = end_time - start_time
 
-        if args.delay - delta_time < 0:
+        if delay - delta_time < 0:
+            metrics.inc('autodoist_cycle_overruns_total')
             logging.debug(
-                'Computation time %d is larger than the specified delay %d. Sleeping skipped.', delta_time, args.delay)
-        elif args.delay >= 0:
-            sleep_time = args.delay - delta_time
+                'Computation time %d is larger than the specified delay %d. Sleeping skipped.', delta_time, delay)
+        elif delay >= 0:
+            sleep_time = max(wake - delta_time, 0)
             logging.debug('Sleeping for %d seconds', sleep_time)
             time.sleep(sleep_time)
 
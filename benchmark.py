@@ -0,0 +1,271 @@
+#!/usr/bin/python3
+
+from todoist.api import TodoistAPI
+from todoist import models
+import autodoist
+import argparse
+import logging
+import random
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+# Workspace sizes that can be selected by name
+PRESETS = {
+    '1k': {'projects': 10, 'sections': 1, 'depth': 2, 'per_parent': 7},
+    '10k': {'projects': 40, 'sections': 2, 'depth': 2, 'per_parent': 9},
+    '100k': {'projects': 200, 'sections': 5, 'depth': 3, 'per_parent': 4},
+}
+
+REGEN_LABEL_NAMES = ('Regen_off', 'Regen_all', 'Regen_all_if_completed')
+
+# Generate a synthetic workspace
+
+
+def generate_workspace(args):
+    """Returns projects, sections, items and labels for an offline TodoistAPI state."""
+    rnd = random.Random(args.seed)
+    today = date.today()
+
+    # Suffixes are drawn according to the requested shares, the rest is untyped
+    suffixes = [(args.pp_suffix, args.parallel), (args.ss_suffix, args.sequential),
+                (args.ps_suffix, args.ps), (args.sp_suffix, args.sp)]
+
+    def suffix():
+        x = rnd.random()
+        for s, share in suffixes:
+            if x < share:
+                return ' ' + s
+            x -= share
+        return ''
+
+    next_id = [0]
+
+    def new_id():
+        next_id[0] += 1
+        return next_id[0]
+
+    label_ids = {'next_action': new_id(), 'blocked': new_id()}
+    for name in REGEN_LABEL_NAMES:
+        label_ids[name] = new_id()
+
+    projects, sections, items = [], [], []
+
+    def add_items(project_id, section_id, parent_id, level):
+        for i in range(args.per_parent):
+            item_id = new_id()
+            labels = []
+            if rnd.random() < 0.3:
+                labels.append(label_ids['next_action'])
+            if rnd.random() < 0.02:
+                labels.append(label_ids['blocked'])
+
+            description = ''
+            due = None
+            x = rnd.random()
+            if x < 0.05:
+                description = 'start={}'.format(
+                    (today + timedelta(days=rnd.randint(-10, 10))).strftime(args.dateformat))
+            elif x < 0.1:
+                description = 'start=due-{}{}'.format(
+                    rnd.randint(1, 3), rnd.choice('dw'))
+            if rnd.random() < 0.3:
+                due = {'date': (today + timedelta(days=rnd.randint(-3, 30))).isoformat(),
+                       'is_recurring': parent_id is None and rnd.random() < 0.3,
+                       'string': 'every day'}
+
+            items.append({'id': item_id, 'content': 'Task {}{}'.format(item_id, suffix() if level == 0 else ''),
+                          'project_id': project_id, 'section_id': section_id, 'parent_id': parent_id,
+                          'child_order': i, 'checked': int(rnd.random() < 0.1), 'in_history': 0,
+                          'labels': labels, 'description': description, 'due': due})
+
+            if level + 1 < args.depth:
+                add_items(project_id, section_id, item_id, level + 1)
+
+    for p in range(args.projects):
+        project_id = new_id()
+        projects.append({'id': project_id, 'name': 'Project {}{}'.format(p, suffix()),
+                         'child_order': p})
+
+        section_ids = [None]
+        for s in range(args.sections):
+            section_id = new_id()
+            sections.append({'id': section_id, 'name': 'Section {}{}'.format(s, suffix()),
+                             'project_id': project_id, 'section_order': s})
+            section_ids.append(section_id)
+
+        for section_id in section_ids:
+            add_items(project_id, section_id, None, 0)
+
+    labels = [{'id': v, 'name': k} for k, v in label_ids.items()]
+
+    return {'projects': projects, 'sections': sections, 'items': items, 'labels': labels}
+
+# Load a workspace into an offline TodoistAPI instance
+
+
+def load_workspace(workspace):
+    api = TodoistAPI(cache=None)
+    for key, model in [('projects', models.Project), ('sections', models.Section),
+                       ('items', models.Item), ('labels', models.Label)]:
+        api.state[key] = [model(dict(x, labels=list(x['labels'])) if key == 'items' else dict(x), api)
+                          for x in workspace[key]]
+    return api
+
+
+def get_label_ids(args, api):
+    names = {x['name']: x['id'] for x in api.state['labels']}
+    label_id = names['next_action']
+    blocked_label_id = names['blocked']
+    if args.regeneration is not None:
+        regen_labels_id = [names[x] for x in args.regen_label_names]
+    else:
+        regen_labels_id = [None, None, None]
+    return label_id, blocked_label_id, regen_labels_id
+
+# Time a function over a number of repeats and keep the best run
+
+
+def best_of(repeat, setup, func):
+    timings = []
+    for _ in range(repeat):
+        state = setup()
+        start = time.perf_counter()
+        func(state)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def run_benchmarks(args, workspace):
+    results = []
+
+    def fresh():
+        api = load_workspace(workspace)
+        return api, get_label_ids(args, api)
+
+    # Full evaluation of all rules
+    def magic(state):
+        api, (label_id, blocked_label_id, regen_labels_id) = state
+        return autodoist.autodoist_magic(args, api, label_id, blocked_label_id, regen_labels_id)
+
+    results.append(('autodoist_magic', len(workspace['items']),
+                    best_of(args.repeat, fresh, magic)))
+
+    # Classification of all names
+    names = [x['name'] for x in workspace['projects']] + \
+        [x['name'] for x in workspace['sections']] + \
+        [x['content'] for x in workspace['items']]
+
+    def classify(state):
+        for name in names:
+            autodoist.check_name(args, name)
+
+    results.append(('check_name', len(names),
+                    best_of(args.repeat, lambda: None, classify)))
+
+    # Item type detection of all items
+    def snapshot():
+        return autodoist.Snapshot(fresh()[0])
+
+    def item_types(snapshot):
+        store = autodoist.StateStore()
+        for item in snapshot.items():
+            autodoist.get_item_type(args, store, item, None)
+
+    results.append(('get_item_type', len(workspace['items']),
+                    best_of(args.repeat, snapshot, item_types)))
+
+    # Queueing of all label updates of a full evaluation
+    def label_setup():
+        state = fresh()
+        overview = magic(state)
+        return state, overview
+
+    def labels(state):
+        (api, (label_id, _, _)), (overview_item_ids, overview_item_labels) = state
+        autodoist.update_labels(api, label_id, overview_item_ids,
+                                overview_item_labels)
+
+    results.append(('update_labels', len(workspace['items']),
+                    best_of(args.repeat, label_setup, labels)))
+
+    # Peak memory of a full evaluation, including the loaded state
+    tracemalloc.start()
+    magic(fresh())
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return results, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark Autodoist on a synthetic workspace, without network access.',
+        formatter_class=autodoist.make_wide(argparse.HelpFormatter, w=120, h=60))
+    parser.add_argument('--size', help='use a preset workspace size.',
+                        choices=sorted(PRESETS), default=None)
+    parser.add_argument('--projects', help='number of projects (default 10).',
+                        default=10, type=int)
+    parser.add_argument('--sections', help='number of sections per project (default 2).',
+                        default=2, type=int)
+    parser.add_argument('--depth', help='nesting depth of the items (default 2).',
+                        default=2, type=int)
+    parser.add_argument('--per_parent', help='number of items per parent (default 7).',
+                        default=7, type=int)
+    parser.add_argument('--sequential', help='share of names with a sequential suffix (default 0.2).',
+                        default=0.2, type=float)
+    parser.add_argument('--parallel', help='share of names with a parallel suffix (default 0.2).',
+                        default=0.2, type=float)
+    parser.add_argument('--ps', help='share of names with a p-s suffix (default 0.1).',
+                        default=0.1, type=float)
+    parser.add_argument('--sp', help='share of names with a s-p suffix (default 0.1).',
+                        default=0.1, type=float)
+    parser.add_argument('--repeat', help='number of runs per benchmark, the best is reported (default 3).',
+                        default=3, type=int)
+    parser.add_argument('--seed', help='seed of the workspace generator (default 0).',
+                        default=0, type=int)
+    parser.add_argument('-r', '--regeneration', help='regeneration mode to benchmark with (default 1).',
+                        default=1, type=int)
+    parser.add_argument('-e', '--end', help='alternative end-of-day hour to benchmark with.',
+                        default=None, type=int)
+    parser.add_argument('-hf', '--hide_future', help='hide-future days to benchmark with (default 7).',
+                        default=7, type=int)
+
+    args = parser.parse_args()
+
+    if args.size is not None:
+        for key, value in PRESETS[args.size].items():
+            setattr(args, key, value)
+
+    # Remaining options as used by Autodoist itself
+    args.pp_suffix = '//'
+    args.ss_suffix = '--'
+    args.ps_suffix = '/-'
+    args.sp_suffix = '-/'
+    args.dateformat = '%d-%m-%Y'
+    args.inbox = None
+    args.label = 'next_action'
+    args.blocked_label = 'blocked'
+    args.regen_label_names = REGEN_LABEL_NAMES
+    args.header_batch = 500
+
+    # Rule warnings would dominate the timings
+    logging.basicConfig(level=logging.ERROR)
+
+    workspace = generate_workspace(args)
+    print('Workspace: {} projects, {} sections, {} items'.format(
+        len(workspace['projects']), len(workspace['sections']), len(workspace['items'])))
+
+    results, peak = run_benchmarks(args, workspace)
+
+    print('{:<18}{:>10}{:>14}{:>14}'.format(
+        'function', 'calls', 'total (ms)', 'per call (us)'))
+    for name, calls, seconds in results:
+        print('{:<18}{:>10}{:>14.2f}{:>14.2f}'.format(
+            name, calls, seconds * 1e3, seconds * 1e6 / max(calls, 1)))
+    print('Peak memory during autodoist_magic: {:.1f} MiB'.format(
+        peak / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import requests
+import time
+
+# Sample events as delivered by the Todoist webhooks
+
+
+def sample_payloads(project_id, item_id):
+    item = {'id': item_id, 'project_id': project_id, 'section_id': None,
+            'parent_id': None, 'content': 'Sample task', 'checked': 0}
+
+    return {
+        'item:added': {'event_name': 'item:added', 'event_data': item},
+        'item:updated': {'event_name': 'item:updated', 'event_data': dict(item, content='Sample task --')},
+        'item:completed': {'event_name': 'item:completed', 'event_data': dict(item, checked=1)},
+        'item:uncompleted': {'event_name': 'item:uncompleted', 'event_data': item},
+        'note:added': {'event_name': 'note:added', 'event_data': {'id': item_id + 1, 'item_id': item_id, 'item': item}},
+        'section:updated': {'event_name': 'section:updated', 'event_data': {'id': item_id + 2, 'project_id': project_id, 'name': 'Sample section //'}},
+        'project:updated': {'event_name': 'project:updated', 'event_data': {'id': project_id, 'name': 'Sample project --'}},
+        'label:updated': {'event_name': 'label:updated', 'event_data': {'id': item_id + 3, 'name': 'next_action'}},
+    }
+
+
+def sign(secret, body):
+    digest = hmac.new(secret.encode('utf-8'), body, hashlib.sha256).digest()
+    return base64.b64encode(digest).decode('ascii')
+
+# Post sample events to a running Autodoist webhook receiver
+
+
+def main():
+    events = sorted(sample_payloads(0, 0))
+
+    parser = argparse.ArgumentParser(
+        description='Stand-in for the Todoist webhooks, which posts sample events to Autodoist.')
+    parser.add_argument('--url', help='address of the webhook receiver (default http://127.0.0.1:8080/).',
+                        default='http://127.0.0.1:8080/')
+    parser.add_argument('--secret', help='client secret to sign the events with.',
+                        default=None)
+    parser.add_argument('--event', help='event to send (default all events).',
+                        choices=events, action='append')
+    parser.add_argument('--project_id', help='project id used in the events.',
+                        default=1, type=int)
+    parser.add_argument('--item_id', help='item id used in the events.',
+                        default=1, type=int)
+    parser.add_argument('--user_id', help='user id used in the events.',
+                        default=1, type=int)
+    parser.add_argument('--interval', help='seconds between events (default 0).',
+                        default=0, type=float)
+
+    args = parser.parse_args()
+
+    payloads = sample_payloads(args.project_id, args.item_id)
+
+    for event_name in args.event or events:
+        payload = dict(payloads[event_name], user_id=args.user_id, version='9',
+                       initiator={'id': args.user_id})
+        body = json.dumps(payload).encode('utf-8')
+
+        headers = {'Content-Type': 'application/json',
+                   'User-Agent': 'Todoist-Webhooks'}
+        if args.secret:
+            headers['X-Todoist-Hmac-SHA256'] = sign(args.secret, body)
+
+        r = requests.post(args.url, data=body, headers=headers, timeout=10)
+        print('{:<18}{}'.format(event_name, r.status_code))
+
+        time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    main()